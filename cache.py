@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from images import PART_SUFFIX
+
+# linux ioctl cloning a file (reflink) on copy-on-write filesystems
+FICLONE = 0x40049409
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """Makes equivalent image URLs look the same
+    :param url: <str>
+    :return: <str> URL with a lower case scheme & host, no default port, no fragment and
+        sorted query parameters
+    """
+    parts = urlsplit(str(url).strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def link_file(source, dest):
+    """Makes dest have the contents of source without copying if possible:
+    hard link first, then reflink, then a plain copy.
+    :param source: <str> Existing file
+    :param dest: <str> Path to create (replaced atomically if it exists)
+    :return: None
+    """
+    tmp_path = dest + PART_SUFFIX
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        try:
+            # posix only
+            import fcntl
+        except ImportError:
+            fcntl = None
+        with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+            cloned = False
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    cloned = True
+                except OSError:
+                    pass
+            if not cloned:
+                shutil.copyfileobj(src, dst)
+    os.replace(tmp_path, dest)
+
+
+class ImageCache:
+    """
+    ImageCache keeps downloaded images, content addressed, so that the same image is never
+    downloaded twice. URLs map to the hash of their contents; contents are stored once.
+    The least recently used images are evicted to stay within a byte budget.
+    """
+
+    INDEX_NAME = "index.json"
+    OBJECTS_DIR = "objects"
+    DEFAULT_PATH = ".cache"
+    DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+    def __init__(self, root=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        """Initialize the ImageCache object
+        :param root: <str> Directory of the cache
+        :param max_bytes: <int> Byte budget of the cache
+        :return: None
+        """
+        super().__init__()
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, self.INDEX_NAME)
+        self.urls = {}
+        self.objects = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_options(cls, options):
+        """Creates an ImageCache out of the "cache" config
+        :param options: <dict> The "cache" config
+        :return: <ImageCache> or None if the cache is not configured
+        """
+        if not options or not options.get("enabled", True):
+            return None
+        return cls(
+            root=options.get("path", cls.DEFAULT_PATH),
+            max_bytes=options.get("max_bytes", cls.DEFAULT_MAX_BYTES),
+        )
+
+    def _load(self):
+        os.makedirs(os.path.join(self.root, self.OBJECTS_DIR), exist_ok=True)
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            print("! Could not read the cache index, starting empty:", e)
+            return
+        self.urls = index.get("urls", {})
+        self.objects = index.get("objects", {})
+        self.size = sum(entry["size"] for entry in self.objects.values())
+
+    def save(self):
+        # every pipeline saves the index: writes of the shared .part file take turns,
+        # without holding up the lookups
+        with self._save_lock:
+            with self._lock:
+                index = {"urls": dict(self.urls), "objects": dict(self.objects)}
+            tmp_path = self.index_path + PART_SUFFIX
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, self.OBJECTS_DIR, digest[:2], digest)
+
+    def _lookup(self, url):
+        """Finds the cached object of an URL, counting the hit or miss
+        :param url: <str>
+        :return: <str> Path of the object or None
+        """
+        key = normalize_url(url)
+        with self._lock:
+            digest = self.urls.get(key)
+            entry = self.objects.get(digest) if digest else None
+            path = self._object_path(digest) if entry else None
+            if path is None or not os.path.exists(path):
+                if entry:
+                    # removed behind our back
+                    self._forget(digest)
+                self.misses += 1
+                return None
+            entry["used"] = time.time()
+            self.hits += 1
+            self.bytes_hit += entry["size"]
+            return path
+
+    def materialize(self, url, dest):
+        """Puts the cached image of an URL at dest
+        :param url: <str> URL of the image
+        :param dest: <str> Where the image is expected
+        :return: <bool> True on a cache hit
+        """
+        path = self._lookup(url)
+        if path is None:
+            return False
+        link_file(path, dest)
+        return True
+
+    def read(self, url):
+        """Reads the cached image of an URL
+        :param url: <str> URL of the image
+        :return: <bytes> or None on a cache miss
+        """
+        path = self._lookup(url)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def store_file(self, url, path):
+        """Caches a downloaded image
+        :param url: <str> URL of the image
+        :param path: <str> Path of the verified image
+        :return: None
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        self._store(url, digest.hexdigest(), os.path.getsize(path), lambda obj: link_file(path, obj))
+
+    def store_bytes(self, url, data):
+        def write(obj):
+            tmp_path = obj + PART_SUFFIX
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, obj)
+
+        self._store(url, hashlib.sha256(data).hexdigest(), len(data), write)
+
+    def _store(self, url, digest, size, write):
+        if size > self.max_bytes:
+            return
+        obj = self._object_path(digest)
+        with self._lock:
+            known = digest in self.objects and os.path.exists(obj)
+        if not known:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            write(obj)
+        with self._lock:
+            if digest not in self.objects:
+                self.objects[digest] = {"size": size, "used": time.time()}
+                self.size += size
+            self.urls[normalize_url(url)] = digest
+            self._evict()
+
+    def _forget(self, digest):
+        entry = self.objects.pop(digest, None)
+        if entry is None:
+            return
+        self.size -= entry["size"]
+        for key in [key for key, value in self.urls.items() if value == digest]:
+            del self.urls[key]
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        by_use = sorted(self.objects.items(), key=lambda item: item[1]["used"])
+        evicted = []
+        for digest, entry in by_use:
+            if self.size <= self.max_bytes:
+                break
+            self.size -= entry["size"]
+            evicted.append(digest)
+        evicted = set(evicted)
+        for digest in evicted:
+            del self.objects[digest]
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+        self.urls = {key: value for key, value in self.urls.items() if value not in evicted}
+        self.evicted += len(evicted)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        print("-" * 75)
+        print("# Image cache:", os.path.abspath(self.root))
+        print(f"## Hits: {self.hits}/{lookups} ({hit_rate:.1%}) | served: {self.bytes_hit / 1024 ** 2:.1f} MiB")
+        print(
+            f"## Size: {self.size / 1024 ** 2:.1f}/{self.max_bytes / 1024 ** 2:.1f} MiB"
+            f" | images: {len(self.objects)} | evicted: {self.evicted}"
+        )
+        print("-" * 75)
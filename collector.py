@@ -3,22 +3,29 @@
 
 import os
 import shutil
+import threading
 import time
-import random
-import requests as req
 
 from tqdm import tqdm
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-# Commenting out cfsrape as it doesn't work anymore. Trying different approach with - cloudscraper
-# import cfscrape
-import cloudscraper
-
-from packer import Packer
+import images
+from cache import ImageCache
+from downloader import Downloader
+from index import ChapterIndex
+from jobqueue import Heartbeat
+from journal import Journal
+from packer import ArchiveWriter, Packer
+from pipeline import Pipeline
+from proxies import ProxyPool
+from ratelimit import RateLimiter
+from retry import Outcome, RetryPolicy
+from scheduler import Scheduler
+from transcoder import Transcoder
 from variant import Variant
+from sweepers.browser import BrowserPool, site_of
 from sweepers.factory import SweeperFactory
 
+
 class Collector:
     """
     Collector can collect chapters, scrape chapter URL and get images
@@ -26,11 +33,41 @@ class Collector:
     """
 
     TMP_COLLECTIONS_DIR = "collections"
+    CHUNK_SIZE = 64 * 1024
+    VARIANT_KEYS = {
+        Variant.TO: "to",
+        Variant.MA: "ma",
+        Variant.MT: "mt",
+    }
 
-    def __init__(self, options, dry_run, clean, parallel, reverse, start_from, use_proxies=True,):
+    def __init__(
+        self,
+        options,
+        dry_run,
+        clean,
+        parallel,
+        reverse,
+        start_from,
+        use_proxies=True,
+        workers=None,
+        per_host=None,
+        stream=None,
+        jobs=None,
+        headless=None,
+        series=None,
+        resume=None,
+    ):
         """Initialize the Collector object
         :param url: <str> The URL from which to collect chapters and other info
         :param dry_run: <bool> Will only print and not download
+        :param parallel: <bool> Will download the pages of a chapter in parallel
+        :param workers: <int> Max concurrent downloads (overrides "download" config)
+        :param per_host: <int> Max concurrent downloads per host (overrides "download" config)
+        :param stream: <bool> Will write pages straight into the archives (overrides "download" config)
+        :param jobs: <int> Number of chapters archived at the same time
+        :param headless: <bool> Will sweep with a headless browser (overrides "browser" config)
+        :param series: <int> Number of series collected at the same time (overrides "scheduler" config)
+        :param resume: <bool> Will resume the run the journal was left by
         :return: None
         """
         super().__init__()
@@ -42,11 +79,54 @@ class Collector:
         self.use_proxies = use_proxies
         self.packer = Packer()
         self.collection_path = self.TMP_COLLECTIONS_DIR
-        self.sweeper = None
+        # sweepers of the series being collected
+        self.sweepers = set()
+        self._sweepers_lock = threading.Lock()
+        self.series = series
         self.start_from = start_from
-        self._init_referrer()
+        self.jobs = jobs
+        self.browser_options = dict(
+            (self.options.get("browser") if self.options is not None else None) or {}
+        )
+        if headless:
+            self.browser_options["headless"] = True
+        # started on first use, then leased to every sweeper of the run
+        self.browser_pool = None
+        self._browser_pool_lock = threading.Lock()
+        self._scraper_lock = threading.Lock()
+        self._scraper_generation = 0
+        # site: (cookies, user agent) the browser got through with
+        self.clearances = {}
+        self.rate_limiters = {}
+        self.retry_policy = RetryPolicy.from_options(
+            self.options.get("retry") if self.options is not None else None
+        )
+        # network sessions are only set up when collecting, archiving does not need them
+        self.session = None
+        self.scraper = None
+        self._init_downloader(workers, per_host, stream)
+        self.cache = ImageCache.from_options(
+            self.options.get("cache") if self.options is not None else None
+        )
+        self.transcoder = Transcoder.from_options(
+            self.options.get("transcode") if self.options is not None else None
+        )
+        self.index = ChapterIndex.from_options(
+            self.options.get("index") if self.options is not None else None
+        )
+        self.proxy_pool = ProxyPool.from_options(
+            self.options.get("proxies") if self.options is not None else None, use_proxies
+        )
+        # opened by collect(), workers share the job queue instead
+        self.resume = resume
+        self.journal = None
 
     def _init_referrer(self):
+        # Commenting out cfsrape as it doesn't work anymore. Trying different approach with - cloudscraper
+        # import cfscrape
+        import cloudscraper
+        import requests as req
+
         self.session = req.session()
         if self.options is not None:
             if (
@@ -57,6 +137,57 @@ class Collector:
                 print("= Added the referer:", self.options["referer"])
                 self.session.headers.update({"referer": self.options["referer"]})
         self.scraper = cloudscraper.create_scraper(sess=self.session)
+        for cookies, _ in self.clearances.values():
+            self._apply_cookies(cookies)
+
+    def _apply_cookies(self, cookies):
+        for cookie in cookies:
+            self.scraper.cookies.set(
+                cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie.get("path", "/")
+            )
+
+    def set_clearance(self, url, cookies, user_agent):
+        """Makes the scraper use the cookies the browser got for a site, along with the
+        user agent they were issued to. They survive clean_scraper.
+        :param url: <str> Any URL of the site
+        :param cookies: <list> Playwright cookies of the site
+        :param user_agent: <str> User agent of the browser
+        :return: None
+        """
+        with self._scraper_lock:
+            self.clearances[site_of(url)] = (cookies, user_agent)
+            self._apply_cookies(cookies)
+
+    def _user_agent(self, url):
+        clearance = self.clearances.get(site_of(url))
+        return clearance[1] if clearance else None
+
+    def _init_downloader(self, workers, per_host, stream):
+        download_options = {}
+        if self.options is not None:
+            download_options = self.options.get("download") or {}
+        workers = workers or download_options.get("workers")
+        per_host = per_host or download_options.get("per_host")
+        self.stream = bool(stream or download_options.get("stream"))
+        if not self.parallel:
+            workers, per_host = 1, 1
+        self.downloader = Downloader(
+            fetch=self._save_img, workers=workers, per_host=per_host
+        )
+
+    def _get_rate_limiter(self, variant):
+        """Every variant gets its own per host rate limiter, from its "rate_limit" config
+        :param variant: <Variant>
+        :return: <RateLimiter>
+        """
+        if variant not in self.rate_limiters:
+            variant_options = {}
+            if self.options is not None:
+                variant_options = self.options.get(self.VARIANT_KEYS[variant]) or {}
+            self.rate_limiters[variant] = RateLimiter.from_options(
+                variant_options.get("rate_limit")
+            )
+        return self.rate_limiters[variant]
 
     def _tear_down_all(self):
         shutil.rmtree(self.TMP_COLLECTIONS_DIR, ignore_errors=True)
@@ -71,9 +202,8 @@ class Collector:
                 continue
             for chap in os.listdir(coll_path):
                 chapter = os.path.join(coll_path, chap)
-                if os.path.isdir(chapter) and os.path.isfile(
-                    os.path.join(chapter, "1.jpg")
-                ):
+                # whatever the pages became (transcoded or not), only packed chapters go
+                if os.path.isdir(chapter) and self.packer.is_packed(coll_path, chap):
                     self._tear_down_chapter(chapter)
         print("=" * 75)
 
@@ -82,139 +212,611 @@ class Collector:
         print("### Removing: ", abs_path)
         shutil.rmtree(abs_path)
 
-    def clean_scraper(self):
-        print("### Something went wrong. Cleaning scraper...")
-        self.session.close()
-        self.scraper.close()
-        self.session = req.session()
-        self.scraper = cloudscraper.create_scraper(sess=self.session)
+    def clean_scraper(self, generation=None):
+        """Replaces the scraper session with a fresh one
+        :param generation: <int> Generation of the scraper that failed. If it was already
+            replaced meanwhile (by another download), nothing is done.
+        :return: None
+        """
+        with self._scraper_lock:
+            if generation is not None and generation != self._scraper_generation:
+                return
+            print("### Something went wrong. Cleaning scraper...")
+            self.session.close()
+            self.scraper.close()
+            self._init_referrer()
+            self._scraper_generation += 1
 
     def collect(self):
         """Collect all chapters and images from chapters
         :return: None
         """
-        tos = self.options["to"]
-        self._collect(tos, Variant.TO)
-        mas = self.options["ma"]
-        self._collect(mas, Variant.MA)
-        mts = self.options["mt"]
-        self._collect(mts, Variant.MT)
+        if self.scraper is None:
+            self._init_referrer()
+        if self.proxy_pool is not None:
+            self.proxy_pool.start()
+        self.journal = Journal.from_options(self.options.get("journal"), resume=self.resume)
+        scheduler = Scheduler.from_options(self.options.get("scheduler"), workers=self.series)
+        for variant, key in self.VARIANT_KEYS.items():
+            urls = self.options[key]["urls"]
+            if len(urls) == 0:
+                print("- No URLs in:", variant)
+                continue
+            print(f"# Found {len(urls)} URLs in {variant}...")
+            for url in urls:
+                scheduler.add(key, url, self._collect_series, self.options[key], variant, url)
+        print(f"# Collecting {scheduler.workers} series at a time, {scheduler.per_site} per site...")
+        try:
+            scheduler.run()
+        finally:
+            self._close_browser_pool()
+        scheduler.report()
+        self.retry_policy.stats.report()
+        if self.cache is not None:
+            self.cache.report()
+        if self.transcoder is not None:
+            print(f"# Transcoding saved {self.transcoder.saved / 1024 ** 2:.1f} MiB")
+        if self.index is not None:
+            self.index.report()
+        if self.journal is not None:
+            self.journal.report()
+        if self.proxy_pool is not None:
+            self.proxy_pool.report()
 
-    def _collect(self, options, variant):
-        """INNER COLLECTOR
+    def enqueue(self, queue):
+        """Queues a job for every series of the config, for workers to collect
+        :param queue: <JobQueue>
         :return: None
         """
-        print("=" * 75)
+        queued = 0
+        for variant, key in self.VARIANT_KEYS.items():
+            for url in self.options[key]["urls"]:
+                queue.enqueue("series", url, {"variant": key, "url": url})
+                queued += 1
+        print(f"# Queued {queued} series in:", queue.path)
 
-        urls = options["urls"]
-        if len(urls) == 0:
-            print("- No URLs in:", variant)
-            print("=" * 75)
-            return
-        print(f"# Found {len(urls)} URLs in {variant}...")
-        print("# Opted for simple collection. CPU count:", os.cpu_count())
-        for url in urls:
-            print("# Initializing sweeper...")
-            self.sweeper = SweeperFactory(
-                main_url=url,
-                dry_run=self.dry_run,
-                filters=options["filter"],
-                reverse=self.reverse,
-                start_from=self.start_from,
-                use_proxies=self.use_proxies,
-            ).create_sweeper(variant)
+    def work(self, queue):
+        """Collects the series claimed from a queue until it is empty.
+        Runs --series (or "scheduler" workers) claiming threads.
+        :param queue: <JobQueue>
+        :return: None
+        """
+        if self.scraper is None:
+            self._init_referrer()
+        if self.proxy_pool is not None:
+            self.proxy_pool.start()
+        scheduler = Scheduler.from_options(self.options.get("scheduler"), workers=self.series)
+        variants = {key: variant for variant, key in self.VARIANT_KEYS.items()}
+
+        def claim_jobs():
+            while True:
+                job = queue.claim()
+                if job is None:
+                    return
+                print(f"# Claimed job {job.id} (attempt {job.attempts}): {job.key}")
+                key = job.payload["variant"]
+                try:
+                    with Heartbeat(queue, job) as heartbeat:
+                        self._collect_series(self.options[key], variants[key], job.payload["url"])
+                except Exception as e:
+                    print(f"!!! Job {job.id} failed: {e}")
+                    queue.fail(job, e)
+                    continue
+                if not heartbeat.lost:
+                    queue.complete(job)
+
+        print(f"# Working on {queue.path} with {scheduler.workers} workers...")
+        # every worker thread claims jobs on its own, the queue is the scheduler
+        for i in range(scheduler.workers):
+            scheduler.add(f"worker-{i}", f"worker-{i}", claim_jobs)
+        try:
+            scheduler.run()
+        finally:
+            self._close_browser_pool()
+        self.retry_policy.stats.report()
+        queue.report()
+
+    def watch(self, queue, watcher, interval):
+        """Polls the watched feeds & series every interval, queues the series with new
+        chapters and collects them. Runs until interrupted.
+        :param queue: <JobQueue>
+        :param watcher: <Watcher>
+        :param interval: <float> Seconds between the start of two polls
+        :return: None
+        """
+        def throttle(variant, url):
+            self._get_rate_limiter(variant).acquire(url)
+
+        while True:
+            started_at = time.monotonic()
+            for key, url in watcher.poll(throttle):
+                queue.enqueue("series", url, {"variant": key, "url": url})
+            watcher.save()
+            self.work(queue)
+            wait = interval - (time.monotonic() - started_at)
+            if wait > 0:
+                print(f"# Next poll in {wait:.0f}s")
+                time.sleep(wait)
+
+    def _collect_series(self, options, variant, url):
+        """Collects a single series: sweeps it while its chapters go through the pipeline
+        :param options: <dict> Config of the variant
+        :param variant: <Variant>
+        :param url: <str> URL of the series
+        :return: None
+        """
+        print("=" * 75)
+        print("# Initializing sweeper...")
+        sweeper = SweeperFactory(
+            main_url=url,
+            dry_run=self.dry_run,
+            filters=options["filter"],
+            reverse=self.reverse,
+            start_from=self.start_from,
+            use_proxies=self.use_proxies,
+            rate_limiter=self._get_rate_limiter(variant),
+            retry_policy=self.retry_policy,
+            browser_options=self.browser_options,
+            allowed_hosts=options.get("allow_hosts"),
+            browser_pool=self._get_browser_pool(),
+        ).create_sweeper(variant)
+        with self._sweepers_lock:
+            self.sweepers.add(sweeper)
+        try:
             print("# Starting up the sweeper...")
-            self.sweeper.init()
-            print("# Sweeping...")
-            self.sweeper.sweep(save_chapter=self._save_chapter)
+            sweeper.init()
+            pipeline = self._create_pipeline().start()
+            try:
+                print("# Sweeping...")
+                sweeper.sweep(
+                    save_chapter=lambda name, imgs, captured: self._chapter_swept(
+                        pipeline, (variant, sweeper.name, name, imgs, captured)
+                    ),
+                    on_clearance=self.set_clearance,
+                    select_chapters=self._chapter_selector(variant),
+                    swept_chapters=self.journal.swept_chapters if self.journal is not None else None,
+                )
+            finally:
+                print("# Waiting for downloads & packing...")
+                pipeline.close()
+                pipeline.report()
+        finally:
             print("# Stopping sweeper...")
-            self.sweeper.stop()
-            # print("# Saving collection...")
-            # self._save_collection()
-
+            sweeper.stop()
+            sweeper.close()
+            with self._sweepers_lock:
+                self.sweepers.discard(sweeper)
         print("=" * 75)
 
+    def _chapter_swept(self, pipeline, chapter):
+        _, collection_name, chapter_name, imgs, _ = chapter
+        if self.journal is not None:
+            self.journal.chapter_swept(collection_name, chapter_name, imgs)
+        pipeline.submit(chapter)
+
+    def _chapter_selector(self, variant):
+        """Picks the chapters left to do: neither packed by the interrupted run (journal),
+        nor by an earlier one (index)
+        :param variant: <Variant>
+        :return: <callable> or None if every chapter is to be done
+        """
+        if self.index is None and self.journal is None:
+            return None
+
+        def select(url, name, chapters):
+            if self.journal is not None:
+                chapters = [
+                    (chapter, chapter_url) for chapter, chapter_url in chapters
+                    if not self.journal.is_packed(name, chapter)
+                ]
+            if self.index is not None:
+                chapters = self.index.select_chapters(url, self.VARIANT_KEYS[variant], name, chapters)
+            return chapters
+
+        return select
+
+    def _get_browser_pool(self):
+        # series threads all get here on their first chapter, a single pool is started
+        with self._browser_pool_lock:
+            if self.browser_pool is None:
+                print("# Starting up the browsers...")
+                self.browser_pool = BrowserPool.from_options(self.browser_options, self.proxy_pool).start()
+            return self.browser_pool
+
+    def _close_browser_pool(self):
+        with self._browser_pool_lock:
+            if self.browser_pool is not None:
+                print("# Stopping the browsers...")
+                self.browser_pool.close()
+                self.browser_pool = None
+
+    def _create_pipeline(self):
+        """Sweeping feeds the download stage, which feeds the (optional) transcode stage,
+        which feeds the pack stage.
+        Every stage runs on its own thread, connected through bounded queues.
+        :return: <Pipeline>
+        """
+        pipeline_options = {}
+        if self.options is not None:
+            pipeline_options = self.options.get("pipeline") or {}
+        stages = [("download", self._save_chapter)]
+        if self.transcoder is not None and not self.stream:
+            stages.append(("transcode", self._transcode_chapter))
+        stages.append(("pack", self._pack_chapter))
+        return Pipeline(
+            stages=stages,
+            queue_size=pipeline_options.get("queue_size"),
+        )
+
     def pack(self):
-        self.packer.pack_all(self.collection_path)
+        self.packer.pack_all(self.collection_path, jobs=self.jobs)
 
     def pack_collections(self):
-        self.packer.pack_collections(self.TMP_COLLECTIONS_DIR)
+        # chapters the journal saw packed are not checked again
+        skip = self.journal.is_packed if self.journal is not None else None
+        self.packer.pack_collections(self.TMP_COLLECTIONS_DIR, jobs=self.jobs, skip=skip)
 
     def clean(self):
-        if self.clean_after:
+        # streamed chapters never leave images behind
+        if self.clean_after and not self.stream:
             self._tear_down_collection()
 
     def close(self):
+        self._close_browser_pool()
+        self.downloader.close()
+        if self.proxy_pool is not None:
+            self.proxy_pool.close()
+        if self.transcoder is not None:
+            self.transcoder.close()
+        if self.cache is not None:
+            self.cache.save()
+        if self.index is not None:
+            self.index.close()
+        if self.journal is not None:
+            self.journal.close()
         if self.scraper is not None:
             self.scraper.close()
-        if self.sweeper is not None:
-            self.sweeper.close()
+        with self._sweepers_lock:
+            sweepers = list(self.sweepers)
+        for sweeper in sweepers:
+            sweeper.close()
 
-    def _save_collection(self):
-        """Saves all chapters
-        :return: None
-        """
-        print("=" * 75)
-        print("## Saving chapters...")
-        # create collection dir
-        self.collection_path = self.sweeper.get_name_path(self.TMP_COLLECTIONS_DIR)
-        os.makedirs(self.collection_path, exist_ok=True)
-        if not self.parallel:
-            print("## Opted for simple downloads. CPU count:", os.cpu_count())
-            for ch_name, i in tqdm(
-                self.sweeper.chapters.items(), desc="## Saving chapters"
-            ):
-                self._save_chapter(ch_name, self.sweeper.get_chapter_imgs(ch_name))
-        else:
-            print("## Opted for parallel downloads. CPU count:", os.cpu_count())
-            with ThreadPoolExecutor(max_workers=os.cpu_count() - 1) as executor:
-                futures = [
-                    executor.submit(
-                        self._save_chapter,
-                        ch_name,
-                        self.sweeper.get_chapter_imgs(ch_name),
-                    )
-                    for ch_name, _ in self.sweeper.chapter_imgs.items()
-                ]
-                for future in as_completed(futures):
-                    pass
-        print("=" * 75)
-
-    def _save_chapter(self, chapter_name, imgs):
+    def _save_chapter(self, chapter):
         """Saves chapter
-        :return: None
+        :param chapter: <tuple> (variant, collection name, chapter name, imgs, captured) as
+            swept, captured being the pages the browser already downloaded
+        :return: <tuple> (collection name, chapter name, complete) to be packed, complete
+            telling whether every page of the chapter is saved
         """
+        variant, collection_name, chapter_name, imgs, captured = chapter
+        rate_limiter = self._get_rate_limiter(variant)
         print("=" * 75)
         print(f"## Saving chapter: {chapter_name} ...")
+        if self.parallel:
+            print(
+                f"## Opted for parallel downloads. Workers: {self.downloader.workers},"
+                f" per host: {self.downloader.per_host}"
+            )
+        col_dir = os.path.join(self.TMP_COLLECTIONS_DIR, collection_name)
+        if self.index is not None:
+            self.index.set_pages(collection_name, chapter_name, imgs)
+        if self.stream:
+            if self._stream_chapter(col_dir, chapter_name, imgs, rate_limiter, captured):
+                if self.journal is not None:
+                    self.journal.chapter_packed(collection_name, chapter_name)
+                if self.index is not None:
+                    self.index.set_downloaded(collection_name, chapter_name, [name for name, _ in imgs])
+                    self.index.set_packed(collection_name, chapter_name)
+            # already packed
+            return None
         # create dirs for imgs
-        col_dir = os.path.join(self.TMP_COLLECTIONS_DIR, self.sweeper.name)
         chapter_dir = os.path.join(col_dir, chapter_name)
         os.makedirs(chapter_dir, exist_ok=True)
         # download images
-        for img in tqdm(imgs, desc="### {0}".format(chapter_name), ascii=True):
-            img_name, img_url = img
+        jobs = []
+        for img_name, img_url in imgs:
             img_path = os.path.join(chapter_dir, img_name)
-            if os.path.exists(img_path):
+            if self._is_page_saved(img_path):
                 continue
-            self._save_img(img_url=img_url, img_path=img_path)
-        # pack the chapter
-        self.pack_collections()
-
-    def _save_img(self, img_url, img_path):
-        ok = False
-        for x in range(0, 10):
-            for i in range(0, 10):
-                # sleep randomly so that we mask network behavior & retry
-                time.sleep(random.uniform(0.2, 1))
-                r = self.scraper.get(img_url, stream=True, timeout=(60, 60))
-                if r.status_code == 200:
-                    with open(img_path, "wb") as f:
-                        for chunk in r.iter_content(1024):
-                            f.write(chunk)
-                    ok = True
-                    break
-            if ok:
-                break
+            if self.transcoder is not None and self.transcoder.output_exists(img_path):
+                continue
+            if img_name in captured:
+                self._save_captured_img(img_url, img_path, captured[img_name])
+                continue
+            if os.path.exists(img_path):
+                # left truncated by an older run: resume it instead of starting over
+                print("### Resuming broken page:", img_path)
+                os.replace(img_path, img_path + images.PART_SUFFIX)
+            jobs.append((img_url, img_path, rate_limiter))
+        self.downloader.download(jobs, desc="### {0}".format(chapter_name))
+        if self.cache is not None:
+            self.cache.save()
+        saved = self._saved_pages(chapter_dir, imgs)
+        if self.index is not None:
+            self.index.set_downloaded(collection_name, chapter_name, saved)
+        return collection_name, chapter_name, bool(imgs) and len(saved) == len(imgs)
+
+    def _saved_pages(self, chapter_dir, imgs):
+        saved = []
+        for img_name, _ in imgs:
+            img_path = os.path.join(chapter_dir, img_name)
+            if self._is_page_saved(img_path) or (
+                self.transcoder is not None and self.transcoder.output_exists(img_path)
+            ):
+                saved.append(img_name)
+        return saved
+
+    def _is_page_saved(self, img_path):
+        """Pages the journal saw saved are trusted, the others are checked on disk"""
+        if self.journal is not None and self.journal.is_page_saved(img_path):
+            return True
+        if images.is_complete_file(img_path):
+            if self.journal is not None:
+                self.journal.page_saved(img_path)
+            return True
+        return False
+
+    def _stream_chapter(self, col_dir, chapter_name, imgs, rate_limiter, captured):
+        """Downloads the pages of a chapter straight into its archive
+        :return: <bool> True if the archive was finished
+        """
+        archive_path = self.packer.archive_path(col_dir, chapter_name)
+        if os.path.exists(archive_path):
+            # archives are only ever renamed into place once finished
+            print("## Already archived:", archive_path)
+            return True
+        os.makedirs(col_dir, exist_ok=True)
+        writer = ArchiveWriter(archive_path, [img_name for img_name, _ in imgs])
+        jobs = []
+        for img_name, img_url in imgs:
+            if img_name in captured:
+                if self.cache is not None:
+                    self.cache.store_bytes(img_url, captured[img_name])
+                self._add_page(writer, img_name, captured[img_name])
+            else:
+                jobs.append((img_url, img_name, rate_limiter, writer))
+        try:
+            self.downloader.download(
+                jobs, desc="### {0}".format(chapter_name), fetch=self._stream_img
+            )
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+        return writer.commit()
+
+    def _transcode_chapter(self, chapter):
+        """Shrinks the pages of a downloaded chapter
+        :param chapter: <tuple> (collection name, chapter name, complete)
+        :return: <tuple> (collection name, chapter name, complete) to be packed
+        """
+        collection_name, chapter_name, _ = chapter
+        chapter_dir = os.path.join(self.TMP_COLLECTIONS_DIR, collection_name, chapter_name)
+        saved = self.transcoder.transcode_chapter(chapter_dir)
+        if saved:
+            print(f"## Transcoding saved {saved / 1024 ** 2:.1f} MiB on: {chapter_name}")
+        return chapter
+
+    def _pack_chapter(self, chapter):
+        """Packs a downloaded chapter
+        :param chapter: <tuple> (collection name, chapter name, complete)
+        :return: None
+        """
+        collection_name, chapter_name, complete = chapter
+        col_dir = os.path.join(self.TMP_COLLECTIONS_DIR, collection_name)
+        self.packer.pack_chapter(col_dir, chapter_name)
+        if not os.path.exists(self.packer.archive_path(col_dir, chapter_name)):
+            return
+        # an archive missing pages is packed again by the next run
+        if self.journal is not None and complete:
+            self.journal.chapter_packed(collection_name, chapter_name)
+        if self.index is not None:
+            self.index.set_packed(collection_name, chapter_name)
+
+    def _save_img(self, img_url, img_path, rate_limiter):
+        """Downloads an image to disk.
+        The image is written to a .part file, resumed with a Range request if a previous
+        attempt (or run) left one behind, and only renamed to img_path once it is whole.
+        :param img_url: <str> URL of the image
+        :param img_path: <str> Where to write the image
+        :param rate_limiter: <RateLimiter> Politeness policy of the host
+        :return: <bool> True if the image was saved
+        """
+        if self.cache is not None and self.cache.materialize(img_url, img_path):
+            self._page_saved(img_path)
+            return True
+        part_path = img_path + images.PART_SUFFIX
+
+        def offset():
+            return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        def receive(r, start):
+            if r.status_code == 416:
+                # nothing left to resume: the .part file is whole or useless
+                if self._finish_img(part_path, img_path):
+                    return True
             else:
-                print("!!! ERROR downloading IMG: ", img_url)
-                self.clean_scraper()
+                written = self._write_img_part(r, part_path, start)
+                if written is False:
+                    return False
+                if self._finish_img(part_path, img_path, whole=written is True):
+                    return True
+            # whole, yet not an image
+            os.remove(part_path)
+            return False
+
+        saved = self._fetch_img(img_url, rate_limiter, receive, offset)
+        if saved:
+            if self.cache is not None:
+                self.cache.store_file(img_url, img_path)
+            self._page_saved(img_path)
+        return saved
+
+    def _page_saved(self, img_path):
+        if self.journal is not None:
+            self.journal.page_saved(img_path)
+
+    def _stream_img(self, img_url, img_name, rate_limiter, writer):
+        """Downloads an image straight into an archive
+        :param img_url: <str> URL of the image
+        :param img_name: <str> Member name of the image in the archive
+        :param rate_limiter: <RateLimiter> Politeness policy of the host
+        :param writer: <ArchiveWriter> The archive of the chapter
+        :return: <bool> True if the image was added
+        """
+
+        if self.cache is not None:
+            data = self.cache.read(img_url)
+            if data is not None:
+                self._add_page(writer, img_name, data)
+                return True
+
+        def receive(r, start):
+            data = b"".join(r.iter_content(self.CHUNK_SIZE))
+            expected = r.headers.get("Content-Length")
+            whole = False
+            if "Content-Encoding" not in r.headers and expected:
+                if int(expected) != len(data):
+                    return False
+                whole = True
+            if not images.is_complete_bytes(data, whole):
+                return False
+            if self.cache is not None:
+                self.cache.store_bytes(img_url, data)
+            self._add_page(writer, img_name, data)
+            return True
+
+        return self._fetch_img(img_url, rate_limiter, receive)
+
+    def _add_page(self, writer, img_name, data):
+        member = None
+        if self.transcoder is not None:
+            data, extension = self.transcoder.transcode(data)
+            if extension is not None:
+                member = os.path.splitext(img_name)[0] + extension
+        writer.add(img_name, data, member)
+
+    def _save_captured_img(self, img_url, img_path, data):
+        """Writes a page the browser already downloaded while sweeping
+        :param img_url: <str> URL of the image
+        :param img_path: <str> Where to write the image
+        :param data: <bytes> The verified image
+        :return: None
+        """
+        part_path = img_path + images.PART_SUFFIX
+        with open(part_path, "wb") as f:
+            f.write(data)
+        os.replace(part_path, img_path)
+        if self.cache is not None:
+            self.cache.store_bytes(img_url, data)
+        self._page_saved(img_path)
+
+    def _fetch_img(self, img_url, rate_limiter, receive, offset=None):
+        """Requests an image, retrying as the retry policy says
+        :param img_url: <str> URL of the image
+        :param rate_limiter: <RateLimiter> Politeness policy of the host
+        :param receive: <callable> receive(response, start) handling a 200/206/416 response.
+            Returns True once the image is stored.
+        :param offset: <callable> Returns the number of bytes already stored, to resume from
+        :return: <bool> True if the image was stored
+        """
+        retry = self.retry_policy.start(img_url)
+        error = None
+        for _ in retry:
+            # wait for our turn on the host
+            rate_limiter.acquire(img_url)
+            generation = self._scraper_generation
+            retry_after = None
+            start = offset() if offset is not None else 0
+            headers = {"Range": f"bytes={start}-"} if start else {}
+            user_agent = self._user_agent(img_url)
+            if user_agent:
+                headers["User-Agent"] = user_agent
+            proxy = self.proxy_pool.acquire() if self.proxy_pool is not None else None
+            started_at = time.monotonic()
+            try:
+                with self.scraper.get(
+                    img_url,
+                    stream=True,
+                    timeout=(60, 60),
+                    headers=headers,
+                    proxies=proxy.requests_proxies if proxy is not None else None,
+                ) as r:
+                    retry_after = self.retry_policy.retry_after(r)
+                    rate_limiter.feedback(img_url, r.status_code, retry_after)
+                    outcome = self.retry_policy.classify_status(r.status_code)
+                    error = f"HTTP {r.status_code}"
+                    if outcome is Outcome.OK or r.status_code == 416:
+                        if receive(r, start):
+                            retry.succeeded()
+                            self._proxy_done(proxy, Outcome.OK, started_at)
+                            return True
+                        outcome = Outcome.RETRY
+                        error = "Incomplete or corrupt image"
+            except Exception as e:
+                outcome = self.retry_policy.classify_exception(e)
+                error = e
+            self._proxy_done(proxy, outcome, started_at)
+            if outcome is Outcome.RESET:
+                self.clean_scraper(generation)
+            if not retry.failed(outcome, retry_after):
+                break
+        print("!!! ERROR downloading IMG: ", img_url, "-", error)
+        return False
+
+    def _proxy_done(self, proxy, outcome, started_at):
+        """Scores the proxy a request went through: answers that are not worth retrying
+        (e.g. 404) are the site's doing, not the proxy's
+        """
+        if proxy is None:
+            return
+        if outcome is Outcome.OK:
+            self.proxy_pool.record(proxy, True, time.monotonic() - started_at)
+        elif outcome is Outcome.FATAL:
+            self.proxy_pool.release(proxy)
+        else:
+            self.proxy_pool.record(proxy, False)
+
+    def _write_img_part(self, r, part_path, offset):
+        """Writes the body of a response to the .part file of an image
+        :param r: <Response> A 200 or 206 response
+        :param part_path: <str> Path of the .part file
+        :param offset: <int> Number of bytes asked to be skipped
+        :return: <bool> True if the .part file now has all the bytes the server announced,
+            False if it misses some, None if the server did not announce a size
+        """
+        expected = None
+        if r.status_code == 206:
+            content_range = images.parse_content_range(r.headers.get("Content-Range"))
+            if content_range is None or content_range[0] != offset:
+                os.remove(part_path)
+                return False
+            mode, expected = "ab", content_range[1]
+        else:
+            # the server sent the whole image
+            mode = "wb"
+            if "Content-Encoding" not in r.headers and r.headers.get("Content-Length"):
+                expected = int(r.headers["Content-Length"])
+        with open(part_path, mode) as f:
+            for chunk in r.iter_content(self.CHUNK_SIZE):
+                f.write(chunk)
+        if expected is None:
+            return None
+        size = os.path.getsize(part_path)
+        if size > expected:
+            os.remove(part_path)
+        return size == expected
+
+    def _finish_img(self, part_path, img_path, whole=False):
+        """Gives a downloaded image its final name if it is whole
+        :param part_path: <str> Path of the .part file
+        :param img_path: <str> Final path of the image
+        :param whole: <bool> True if the .part file has the size the server announced
+        :return: <bool> True if the image was whole
+        """
+        if not images.is_complete_file(part_path, whole):
+            return False
+        os.replace(part_path, img_path)
+        return True
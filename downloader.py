@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from tqdm import tqdm
+
+
+class Downloader:
+    """
+    Downloader fetches the pages of a chapter through a bounded pool of workers.
+    Concurrency is capped globally (workers) and towards every single host (per_host).
+    A job only goes to the pool once its host has a free slot, the others wait in the queue
+    of their host: a busy host never holds workers the other hosts could use.
+    """
+
+    DEFAULT_WORKERS = 8
+    DEFAULT_PER_HOST = 4
+
+    def __init__(self, fetch, workers=None, per_host=None):
+        """Initialize the Downloader object
+        :param fetch: <callable> fetch(img_url, img_path, *args) that downloads a single image
+        :param workers: <int> Max number of concurrent downloads
+        :param per_host: <int> Max number of concurrent downloads towards the same host
+        :return: None
+        """
+        super().__init__()
+        self.fetch = fetch
+        self.workers = max(1, workers or self.DEFAULT_WORKERS)
+        self.per_host = max(1, min(per_host or self.DEFAULT_PER_HOST, self.workers))
+        self.executor = None
+        # host: downloads running, jobs waiting for a slot
+        self._active = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="downloader"
+                )
+            return self.executor
+
+    def _schedule(self, executor, fetch, job, done):
+        """Submits a job if its host has a free slot, queues it otherwise
+        :param executor: <ThreadPoolExecutor>
+        :param fetch: <callable>
+        :param job: <tuple> (img_url, img_path, *args)
+        :param done: <Queue> Gets (job, future) once the job is over
+        :return: None
+        """
+        host = urlparse(job[0]).netloc
+        with self._lock:
+            if self._active.get(host, 0) >= self.per_host:
+                self._pending.setdefault(host, deque()).append((fetch, job, done))
+                return
+            self._active[host] = self._active.get(host, 0) + 1
+        self._submit(executor, host, fetch, job, done)
+
+    def _submit(self, executor, host, fetch, job, done):
+        future = executor.submit(fetch, *job)
+        future.add_done_callback(lambda f: self._release(executor, host, job, f, done))
+
+    def _release(self, executor, host, job, future, done):
+        """A download is over: its slot goes to the next job of the same host
+        :return: None
+        """
+        done.put((job, future))
+        with self._lock:
+            pending = self._pending.get(host)
+            if not pending:
+                self._active[host] -= 1
+                return
+            fetch, next_job, next_done = pending.popleft()
+        self._submit(executor, host, fetch, next_job, next_done)
+
+    def download(self, jobs, desc=None, fetch=None):
+        """Downloads all the jobs and waits for every one of them to finish
+        :param jobs: <list> (img_url, img_path, *args) tuples, passed as is to fetch
+        :param desc: <str> Progress bar description
+        :param fetch: <callable> Used instead of the default fetch for these jobs
+        :return: <int> Number of failed downloads
+        """
+        executor = self._get_executor()
+        fetch = fetch or self.fetch
+        jobs = list(jobs)
+        done = queue.Queue()
+        for job in jobs:
+            self._schedule(executor, fetch, job, done)
+        failed = 0
+        for _ in tqdm(range(len(jobs)), desc=desc, ascii=True):
+            job, future = done.get()
+            try:
+                if future.result() is False:
+                    failed += 1
+            except Exception as e:
+                failed += 1
+                print("!!! ERROR downloading IMG:", job[0], "-", e)
+        return failed
+
+    def close(self):
+        with self._lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            self.executor = None
@@ -441,7 +441,9 @@ class HelperProxy:
         return self.index
 
     def get_rand_index(self):
-        self.index = random.randint(0, len(self.PROXY_LIST))
+        # randint includes its upper bound
+        self.index = random.randint(0, len(self.PROXY_LIST) - 1)
+        return self.index
 
     def get_proxy(self):
         if self.current_working is not None:
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+PART_SUFFIX = ".part"
+
+HEAD_SIZE = 16
+# cameras and editors may append a trailer after the end marker of a JPEG
+TAIL_SIZE = 4096
+
+JPEG_HEAD = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+PNG_HEAD = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"IEND\xaeB`\x82"
+GIF_HEADS = (b"GIF87a", b"GIF89a")
+GIF_TRAILER = b"\x3b"
+
+
+def sniff_format(head):
+    """Tells the image format from the first bytes of a file
+    :param head: <bytes> At least the first 12 bytes
+    :return: <str> "jpeg", "png", "gif", "webp", "avif" or None if unknown
+    """
+    if head.startswith(JPEG_HEAD):
+        return "jpeg"
+    if head.startswith(PNG_HEAD):
+        return "png"
+    if head.startswith(GIF_HEADS):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis"):
+        return "avif"
+    return None
+
+
+def is_complete(head, tail, size, whole=False):
+    """Cheap integrity check: a known image signature and its end marker
+    :param head: <bytes> The first bytes of the image
+    :param tail: <bytes> The last bytes of the image
+    :param size: <int> Size of the image in bytes
+    :param whole: <bool> True if the size is the one the server announced, the signature
+        is then enough
+    :return: <bool>
+    """
+    image_format = sniff_format(head)
+    if whole:
+        return image_format is not None
+    # some encoders pad the end of the image with zeros
+    tail = tail.rstrip(b"\x00")
+    if image_format == "jpeg":
+        return JPEG_EOI in tail
+    if image_format == "png":
+        return tail.endswith(PNG_IEND)
+    if image_format == "gif":
+        return tail.endswith(GIF_TRAILER)
+    if image_format == "webp":
+        return int.from_bytes(head[4:8], "little") + 8 <= size
+    # no cheap end marker to look for
+    return image_format == "avif"
+
+
+def is_complete_bytes(data, whole=False):
+    return is_complete(data[:HEAD_SIZE], data[-TAIL_SIZE:], len(data), whole)
+
+
+def is_complete_file(path, whole=False):
+    """Checks that a downloaded image is whole
+    :param path: <str> Path of the image
+    :param whole: <bool> True if its size is the one the server announced
+    :return: <bool> False if the image is missing, truncated or not an image at all
+    """
+    try:
+        size = os.path.getsize(path)
+        if size < HEAD_SIZE:
+            return False
+        with open(path, "rb") as f:
+            head = f.read(HEAD_SIZE)
+            f.seek(max(0, size - TAIL_SIZE))
+            tail = f.read(TAIL_SIZE)
+    except OSError:
+        return False
+    return is_complete(head, tail, size, whole)
+
+
+def parse_content_range(value):
+    """Parses a "bytes start-end/total" Content-Range header
+    :param value: <str> The header value
+    :return: <tuple> (start, total), total being None when unknown, or None if invalid
+    """
+    try:
+        unit, _, rest = value.partition(" ")
+        span, _, total = rest.partition("/")
+        start = int(span.split("-")[0])
+        if unit != "bytes":
+            return None
+        return start, None if total == "*" else int(total)
+    except (AttributeError, ValueError):
+        return None
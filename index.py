@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+import time
+
+# chapter statuses, in the order a chapter goes through them
+NEW = "new"
+SWEPT = "swept"
+DOWNLOADED = "downloaded"
+PACKED = "packed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    variant TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    series TEXT NOT NULL REFERENCES series(name),
+    name TEXT NOT NULL,
+    url TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL,
+    PRIMARY KEY (series, name)
+);
+CREATE TABLE IF NOT EXISTS pages (
+    series TEXT NOT NULL,
+    chapter TEXT NOT NULL,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (series, chapter, name)
+);
+"""
+
+
+class ChapterIndex:
+    """
+    ChapterIndex remembers, across runs, every series, its chapters, the pages of every chapter
+    and how far each one got (swept, downloaded, packed). Sweeping only goes through the
+    chapters that are not packed yet.
+    """
+
+    DEFAULT_PATH = "index.db"
+
+    def __init__(self, path=DEFAULT_PATH):
+        """Initialize the ChapterIndex object
+        :param path: <str> Path of the SQLite database
+        :return: None
+        """
+        super().__init__()
+        self.path = path
+        self.skipped = 0
+        self._lock = threading.Lock()
+        # used by the sweeping and the pipeline threads, always under the lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    @classmethod
+    def from_options(cls, options):
+        """Creates a ChapterIndex out of the "index" config
+        :param options: <dict> The "index" config
+        :return: <ChapterIndex> or None if the index is not configured
+        """
+        if not options or not options.get("enabled", True):
+            return None
+        return cls(path=options.get("path", cls.DEFAULT_PATH))
+
+    def select_chapters(self, series_url, variant, series_name, chapters):
+        """Records the chapters found on a series page and picks the ones left to do
+        :param series_url: <str> URL of the series
+        :param variant: <str> Variant of the series
+        :param series_name: <str> Name of the series (its directory)
+        :param chapters: <list> (chapter name, chapter url) as swept
+        :return: <list> (chapter name, chapter url) of the chapters that are not packed yet
+        """
+        now = time.time()
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT INTO series (name, url, variant, updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET url = excluded.url, updated_at = excluded.updated_at",
+                (series_name, series_url, variant, now),
+            )
+            self.db.executemany(
+                "INSERT INTO chapters (series, name, url, status, updated_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(series, name) DO UPDATE SET url = excluded.url",
+                [(series_name, name, url, NEW, now) for name, url in chapters],
+            )
+            packed = {
+                name for name, in self.db.execute(
+                    "SELECT name FROM chapters WHERE series = ? AND status = ?", (series_name, PACKED)
+                )
+            }
+        self.skipped += len([name for name, _ in chapters if name in packed])
+        return [(name, url) for name, url in chapters if name not in packed]
+
+    def set_pages(self, series_name, chapter_name, imgs):
+        """Records the pages of a swept chapter, forgetting the pages of earlier sweeps
+        :param series_name: <str> Name of the series
+        :param chapter_name: <str> Name of the chapter
+        :param imgs: <list> (page name, page url) tuples
+        :return: None
+        """
+        with self._lock, self.db:
+            self.db.execute(
+                "DELETE FROM pages WHERE series = ? AND chapter = ?", (series_name, chapter_name)
+            )
+            self.db.executemany(
+                "INSERT INTO pages (series, chapter, name, url) VALUES (?, ?, ?, ?)",
+                [(series_name, chapter_name, name, url) for name, url in imgs],
+            )
+            self._set_status(series_name, chapter_name, SWEPT)
+
+    def set_downloaded(self, series_name, chapter_name, done):
+        """Records which pages of a chapter are on disk
+        :param series_name: <str> Name of the series
+        :param chapter_name: <str> Name of the chapter
+        :param done: <list> Names of the pages that were saved
+        :return: <bool> True if every page of the chapter is saved, False for a chapter
+            without pages
+        """
+        with self._lock, self.db:
+            self.db.executemany(
+                "UPDATE pages SET done = 1 WHERE series = ? AND chapter = ? AND name = ?",
+                [(series_name, chapter_name, name) for name in done],
+            )
+            pages, saved = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(done), 0) FROM pages WHERE series = ? AND chapter = ?",
+                (series_name, chapter_name),
+            ).fetchone()
+            # a chapter without pages stays swept, to be swept again
+            complete = pages > 0 and saved == pages
+            if complete:
+                self._set_status(series_name, chapter_name, DOWNLOADED)
+        return complete
+
+    def set_packed(self, series_name, chapter_name):
+        """Records that a chapter is archived, unless some of its pages were missing
+        :param series_name: <str> Name of the series
+        :param chapter_name: <str> Name of the chapter
+        :return: None
+        """
+        with self._lock, self.db:
+            self.db.execute(
+                "UPDATE chapters SET status = ?, updated_at = ? WHERE series = ? AND name = ? AND status = ?",
+                (PACKED, time.time(), series_name, chapter_name, DOWNLOADED),
+            )
+
+    def _set_status(self, series_name, chapter_name, status):
+        self.db.execute(
+            "UPDATE chapters SET status = ?, updated_at = ? WHERE series = ? AND name = ?",
+            (status, time.time(), series_name, chapter_name),
+        )
+
+    def report(self):
+        with self._lock:
+            counts = dict(self.db.execute("SELECT status, COUNT(*) FROM chapters GROUP BY status"))
+            (series,), = self.db.execute("SELECT COUNT(*) FROM series")
+        print("-" * 75)
+        print("# Chapter index:", self.path)
+        print(f"## Series: {series} | chapters skipped this run: {self.skipped}")
+        print("## Chapters: " + " | ".join(
+            f"{status}: {counts.get(status, 0)}" for status in (NEW, SWEPT, DOWNLOADED, PACKED)
+        ))
+        print("-" * 75)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
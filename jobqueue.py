@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+"""
+
+
+def worker_id():
+    """Identifies the calling thread among every worker sharing the queue"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+class Job:
+    def __init__(self, job_id, kind, key, payload, owner, attempts):
+        self.id = job_id
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.owner = owner
+        self.attempts = attempts
+
+
+class JobQueue:
+    """
+    JobQueue is a durable queue shared by worker processes, on the same or other machines
+    that see the same file. A claimed job is leased to its worker, who keeps it alive with
+    heartbeats; a job whose lease expires (the worker died) goes back to the queue.
+    Claims run in an immediate transaction, so no two workers ever hold the same job.
+    The default rollback journal only needs file locks, which is what a database shared
+    over a network filesystem gets. WAL is faster but needs shared memory, so it is only
+    for workers on a single machine.
+    """
+
+    DEFAULT_PATH = "queue.db"
+    DEFAULT_LEASE = 300
+    DEFAULT_MAX_ATTEMPTS = 3
+
+    def __init__(self, path=DEFAULT_PATH, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS, wal=False):
+        """Initialize the JobQueue object
+        :param path: <str> Path of the SQLite database
+        :param lease: <float> Seconds a claimed job stays with its worker without a heartbeat
+        :param max_attempts: <int> Claims of a job before it is failed for good
+        :param wal: <bool> Uses write-ahead logging, only when every worker runs on this machine
+        :return: None
+        """
+        super().__init__()
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        # transactions are handled by hand, see claim()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        # a database left in WAL mode is switched back too
+        self.db.execute("PRAGMA journal_mode=" + ("WAL" if wal else "DELETE"))
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def from_options(cls, options):
+        """Creates a JobQueue out of the "queue" config
+        :param options: <dict> The "queue" config or None for the defaults
+        :return: <JobQueue>
+        """
+        options = options or {}
+        return cls(
+            path=options.get("path", cls.DEFAULT_PATH),
+            lease=options.get("lease", cls.DEFAULT_LEASE),
+            max_attempts=options.get("max_attempts", cls.DEFAULT_MAX_ATTEMPTS),
+            wal=options.get("wal", False),
+        )
+
+    def _transaction(self, fn, *args):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(*args)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def enqueue(self, kind, key, payload):
+        """Queues a job, unless the same job is already queued or running.
+        A finished or failed job is queued again.
+        :param kind: <str> Kind of job, e.g. "series"
+        :param key: <str> Identifies the job among its kind, e.g. the URL
+        :param payload: <dict> What the worker needs to run the job
+        :return: None
+        """
+        def insert():
+            self.db.execute(
+                "INSERT INTO jobs (kind, key, payload, status, created_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(kind, key) DO UPDATE SET payload = excluded.payload,"
+                " status = excluded.status, attempts = 0, error = NULL, owner = NULL,"
+                " lease_until = NULL, created_at = excluded.created_at"
+                " WHERE jobs.status IN (?, ?)",
+                (kind, key, json.dumps(payload), QUEUED, time.time(), DONE, FAILED),
+            )
+
+        self._transaction(insert)
+
+    def claim(self, owner=None):
+        """Leases the oldest queued job, or a job whose lease expired
+        :param owner: <str> Who claims the job, the calling thread by default
+        :return: <Job> or None if there is nothing to do
+        """
+        owner = owner or worker_id()
+
+        def take():
+            now = time.time()
+            row = self.db.execute(
+                "SELECT id, kind, key, payload, attempts FROM jobs"
+                " WHERE status = ? OR (status = ? AND lease_until < ?)"
+                " ORDER BY id LIMIT 1",
+                (QUEUED, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, kind, key, payload, attempts = row
+            if attempts >= self.max_attempts:
+                # its workers keep dying on it
+                self.db.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                    (FAILED, "lease expired too many times", now, job_id),
+                )
+                return take()
+            self.db.execute(
+                "UPDATE jobs SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1,"
+                " started_at = ? WHERE id = ?",
+                (LEASED, owner, now + self.lease, now, job_id),
+            )
+            return Job(job_id, kind, key, json.loads(payload), owner, attempts + 1)
+
+        return self._transaction(take)
+
+    def heartbeat(self, job):
+        """Extends the lease of a job
+        :param job: <Job>
+        :return: <bool> False if the job is not ours anymore
+        """
+        def extend():
+            return self.db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = ?",
+                (time.time() + self.lease, job.id, job.owner, LEASED),
+            ).rowcount == 1
+
+        return self._transaction(extend)
+
+    def complete(self, job):
+        self._finish(job, DONE, None)
+
+    def fail(self, job, error):
+        """Gives a job back to the queue, or fails it for good once out of attempts
+        :param job: <Job>
+        :param error: <str> What went wrong
+        :return: None
+        """
+        status = FAILED if job.attempts >= self.max_attempts else QUEUED
+        self._finish(job, status, str(error))
+
+    def _finish(self, job, status, error):
+        def update():
+            self.db.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_until = NULL"
+                " WHERE id = ? AND owner = ? AND status = ?",
+                (status, error, time.time(), job.id, job.owner, LEASED),
+            )
+
+        self._transaction(update)
+
+    def stats(self, window=3600):
+        """Depth and throughput of the queue
+        :param window: <float> Seconds the throughput is measured over
+        :return: <dict>
+        """
+        now = time.time()
+        with self._lock:
+            counts = dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+            (expired,), = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND lease_until < ?", (LEASED, now)
+            )
+            finished, duration = self.db.execute(
+                "SELECT COUNT(*), AVG(finished_at - started_at) FROM jobs"
+                " WHERE status = ? AND finished_at >= ?",
+                (DONE, now - window),
+            ).fetchone()
+            workers = [
+                owner for owner, in self.db.execute(
+                    "SELECT DISTINCT owner FROM jobs WHERE status = ? AND lease_until >= ?", (LEASED, now)
+                )
+            ]
+        return {
+            "counts": {status: counts.get(status, 0) for status in (QUEUED, LEASED, DONE, FAILED)},
+            "expired": expired,
+            "finished": finished,
+            "duration": duration or 0.0,
+            "window": window,
+            "workers": workers,
+        }
+
+    def report(self):
+        stats = self.stats()
+        counts = stats["counts"]
+        print("-" * 75)
+        print("# Job queue:", os.path.abspath(self.path))
+        print("## " + " | ".join(f"{status}: {count}" for status, count in counts.items()))
+        print(f"## Expired leases (to be claimed again): {stats['expired']}")
+        print(
+            f"## Done in the last {stats['window'] / 60:.0f} min: {stats['finished']}"
+            f" ({stats['finished'] / (stats['window'] / 3600):.1f}/h, {stats['duration']:.1f}s avg)"
+        )
+        print(f"## Active workers: {len(stats['workers'])}")
+        for owner in stats["workers"]:
+            print("### Worker:", owner)
+        print("-" * 75)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class Heartbeat:
+    """
+    Heartbeat keeps the lease of a job alive from a background thread while it runs:
+        with Heartbeat(queue, job):
+            ...
+    """
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name=f"heartbeat-{job.id}", daemon=True)
+
+    def _beat(self):
+        while not self._stopped.wait(self.queue.lease / 3):
+            if not self.queue.heartbeat(self.job):
+                print(f"!!! Lost the lease of job {self.job.id}: {self.job.key}")
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        return False
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+SWEPT = "swept"
+PAGE = "page"
+PACKED = "packed"
+
+
+class Journal:
+    """
+    Journal records, as the run goes, every chapter swept (with its pages), every page saved
+    and verified, and every archive packed. Each record is a JSON line written and fsync'ed
+    before the run goes on, so a crash loses at most the record being written.
+    A resumed run replays the journal of the previous one: swept chapters are not navigated
+    again, saved pages are not checked again and packed chapters are left alone.
+    """
+
+    DEFAULT_PATH = "journal.jsonl"
+
+    def __init__(self, path=DEFAULT_PATH, resume=False):
+        """Initialize the Journal object
+        :param path: <str> Path of the journal
+        :param resume: <bool> Replays the journal instead of starting a new one
+        :return: None
+        """
+        super().__init__()
+        self.path = path
+        self.resume = resume
+        # series: {chapter: imgs}
+        self.swept = {}
+        self.pages = set()
+        self.packed = set()
+        self.replayed = 0
+        self._lock = threading.Lock()
+        torn = self._replay() if resume else False
+        self.file = open(path, "a" if resume else "w")
+        if torn:
+            # the crash left a line without its end
+            self.file.write("\n")
+        self._write({"event": "run", "resume": resume})
+
+    @classmethod
+    def from_options(cls, options, resume=False):
+        """Creates a Journal out of the "journal" config
+        :param options: <dict> The "journal" config or None for the defaults
+        :param resume: <bool> Replays the journal of the previous run
+        :return: <Journal> or None if journaling is disabled
+        """
+        options = options or {}
+        if not options.get("enabled", True):
+            return None
+        return cls(path=options.get("path", cls.DEFAULT_PATH), resume=resume)
+
+    def _replay(self):
+        """Loads the records of the previous run
+        :return: <bool> True if the last line was torn
+        """
+        if not os.path.exists(self.path):
+            print("! No journal to resume from:", self.path)
+            return False
+        line = ""
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn by the crash
+                    continue
+                event = record.get("event")
+                if event == SWEPT:
+                    chapters = self.swept.setdefault(record["series"], {})
+                    chapters[record["chapter"]] = [tuple(img) for img in record["imgs"]]
+                elif event == PAGE:
+                    self.pages.add(record["path"])
+                elif event == PACKED:
+                    self.packed.add((record["series"], record["chapter"]))
+                else:
+                    continue
+                self.replayed += 1
+        print(f"# Resuming from {self.path}: {self.replayed} records")
+        return bool(line) and not line.endswith("\n")
+
+    def _write(self, record):
+        record["at"] = time.time()
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def chapter_swept(self, series_name, chapter_name, imgs):
+        """Records the pages of a swept chapter
+        :param series_name: <str> Name of the series
+        :param chapter_name: <str> Name of the chapter
+        :param imgs: <list> (page name, page url) tuples
+        :return: None
+        """
+        imgs = [tuple(img) for img in imgs]
+        with self._lock:
+            chapters = self.swept.setdefault(series_name, {})
+            if chapters.get(chapter_name) == imgs:
+                return
+            chapters[chapter_name] = imgs
+        self._write({"event": SWEPT, "series": series_name, "chapter": chapter_name, "imgs": imgs})
+
+    def swept_chapters(self, series_name):
+        """
+        :param series_name: <str> Name of the series
+        :return: <dict> {chapter name: imgs} of the chapters already swept
+        """
+        with self._lock:
+            return dict(self.swept.get(series_name, {}))
+
+    def page_saved(self, path):
+        """Records a page that is on disk and verified
+        :param path: <str> Path of the page
+        :return: None
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            if path in self.pages:
+                return
+            self.pages.add(path)
+        self._write({"event": PAGE, "path": path})
+
+    def is_page_saved(self, path):
+        return os.path.normpath(path) in self.pages
+
+    def chapter_packed(self, series_name, chapter_name):
+        with self._lock:
+            if (series_name, chapter_name) in self.packed:
+                return
+            self.packed.add((series_name, chapter_name))
+        self._write({"event": PACKED, "series": series_name, "chapter": chapter_name})
+
+    def is_packed(self, series_name, chapter_name):
+        return (series_name, chapter_name) in self.packed
+
+    def report(self):
+        print("-" * 75)
+        print("# Journal:", self.path)
+        print(
+            f"## Chapters swept: {sum(len(c) for c in self.swept.values())}"
+            f" | pages saved: {len(self.pages)} | chapters packed: {len(self.packed)}"
+        )
+        print("-" * 75)
+
+    def close(self):
+        with self._lock:
+            self.file.close()
@@ -8,6 +8,9 @@ import time
 
 import collector
 import helpers
+from index import ChapterIndex
+from jobqueue import JobQueue
+from watcher import Watcher
 
 
 def archive(args, options):
@@ -19,14 +22,15 @@ def archive(args, options):
         reverse=args.reverse,
         start_from=args.start,
         use_proxies=args.use_proxies,
+        jobs=args.jobs,
     )
     c.pack_collections()
     c.clean()
     c.close()
 
 
-def collect(args, options):
-    c = collector.Collector(
+def create_collector(args, options):
+    return collector.Collector(
         options=options,
         dry_run=args.dry,
         clean=args.clean,
@@ -34,7 +38,18 @@ def collect(args, options):
         reverse=args.reverse,
         start_from=args.start,
         use_proxies=args.use_proxies,
+        workers=args.workers,
+        per_host=args.per_host,
+        stream=args.stream,
+        jobs=args.jobs,
+        headless=args.headless,
+        series=args.series,
+        resume=args.resume,
     )
+
+
+def collect(args, options):
+    c = create_collector(args, options)
     try:
         c.collect()
     except Exception as e:
@@ -47,6 +62,57 @@ def collect(args, options):
     # c.close()
 
 
+def enqueue(args, options):
+    queue = JobQueue.from_options(options.get("queue"))
+    c = create_collector(args, options)
+    c.enqueue(queue)
+    queue.report()
+    queue.close()
+
+
+def work(args, options):
+    queue = JobQueue.from_options(options.get("queue"))
+    c = create_collector(args, options)
+    try:
+        c.work(queue)
+    except Exception as e:
+        print("!!! Exception occured:", e)
+    c.pack_collections()
+    c.clean()
+    c.close()
+    queue.close()
+
+
+def watch(args, options):
+    # every poll collects its series again: without the index, all their chapters would be
+    # swept again too
+    index_options = options.get("index")
+    if not index_options:
+        options = dict(options, index={"path": ChapterIndex.DEFAULT_PATH})
+    elif not index_options.get("enabled", True):
+        print("= ERROR: --watch needs the chapter index, enable the \"index\" section. Exiting...")
+        sys.exit(1)
+    queue = JobQueue.from_options(options.get("queue"))
+    c = create_collector(args, options)
+    watcher = Watcher.from_options(options, c.VARIANT_KEYS)
+    try:
+        c.watch(queue, watcher, args.watch)
+    except KeyboardInterrupt:
+        print("= Stopped watching")
+    finally:
+        watcher.save()
+        watcher.close()
+        c.clean()
+        c.close()
+        queue.close()
+
+
+def queue_stats(options):
+    queue = JobQueue.from_options((options or {}).get("queue"))
+    queue.report()
+    queue.close()
+
+
 def main(args):
     if not helpers.url_validator(args):
         print("= ERROR: URL is not valid. Please provide a valid URL. Exiting...")
@@ -55,12 +121,28 @@ def main(args):
     if args.archive:
         archive(args, None)
         return
+    if args.queue_stats:
+        options = None
+        if args.json is not None:
+            with open(args.json) as json_file:
+                options = json.load(json_file)
+        queue_stats(options)
+        return
     if args.json is None:
         print("= No configuration given")
         parser.print_help()
         return
     with open(args.json) as json_file:
         options = json.load(json_file)
+    if args.enqueue:
+        enqueue(args, options)
+        return
+    if args.worker:
+        work(args, options)
+        return
+    if args.watch:
+        watch(args, options)
+        return
     # collect
     collect(args, options)
 
@@ -77,6 +159,12 @@ if __name__ == "__main__":
         dest="archive",
         action="store_true",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        metavar="jobs",
+        help="number of chapters archived at the same time",
+    )
     parser.add_argument(
         "-u", "--url", type=str, metavar="url", help="URL to scrape chapters from"
     )
@@ -93,6 +181,68 @@ if __name__ == "__main__":
         dest="parallel",
         action="store_true",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="workers",
+        help="max concurrent page downloads when running in parallel",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        metavar="per_host",
+        help="max concurrent page downloads towards the same host",
+    )
+    parser.add_argument(
+        "--stream",
+        help="download pages straight into the .cbz archives",
+        dest="stream",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--series",
+        help="number of series collected at the same time",
+        dest="series",
+        type=int,
+        metavar="series",
+    )
+    parser.add_argument(
+        "--enqueue",
+        help="queue the series of the config for workers instead of collecting them",
+        dest="enqueue",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--worker",
+        help="collect the series claimed from the job queue until it is empty",
+        dest="worker",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--queue-stats",
+        help="print the depth and throughput of the job queue",
+        dest="queue_stats",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help="resume the interrupted run from its journal",
+        dest="resume",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch",
+        help="poll the watched feeds & series every interval seconds and collect what is new",
+        dest="watch",
+        type=int,
+        metavar="interval",
+    )
+    parser.add_argument(
+        "--headless",
+        help="sweep with a headless browser, blocking what sweeping does not need",
+        dest="headless",
+        action="store_true",
+    )
     parser.add_argument(
         "-d",
         "--dry-run",
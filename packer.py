@@ -1,22 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
 import os
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tqdm import tqdm
 
+from images import PART_SUFFIX
+
 
 class Packer:
     """
     Packer has the ability of sweeping a given directory and create cbz archives based on contents
+    Every collection keeps a manifest of what its archives were packed from, so that archives
+    that are up to date are not packed again.
     """
 
+    MANIFEST_NAME = ".manifest.json"
+
     def __init__(self):
         """Initialize the Packer object
         :return: None
         """
         super().__init__()
+        self.manifests = {}
+        self._lock = threading.Lock()
 
     def files(self, source_dir):
         """Returns all files in the path. We already know there should be only images there.
@@ -24,13 +35,24 @@ class Packer:
         :return: None
         """
         for file_name in os.listdir(source_dir):
+            if file_name.endswith(PART_SUFFIX) or file_name.startswith("."):
+                # unfinished download or bookkeeping
+                continue
             yield os.path.join(source_dir, file_name)
 
-    def pack_collections(self, source_dir):
+    def pack_collections(self, source_dir, jobs=None, skip=None):
+        """Archives the chapters of every collection in a directory
+        :param source_dir: <str> Directory of the collections
+        :param jobs: <int> Number of chapters packed at the same time
+        :param skip: <callable> skip(collection name, chapter name) telling the chapters known
+            to be packed already, which are not looked at
+        :return: None
+        """
         print("=" * 75)
         if not os.path.exists(str(source_dir)):
             return
-        for collection in tqdm(os.listdir(source_dir), desc="# Archiving", ascii=True):
+        chapters = []
+        for collection in os.listdir(source_dir):
             coll_path = os.path.join(source_dir, collection)
             if (
                 os.path.isfile(coll_path)
@@ -39,38 +61,174 @@ class Packer:
             ):
                 print("## Skipping:", coll_path)
                 continue
-            self.pack_all(coll_path)
+            chapters.extend(
+                (coll_path, chapter_name) for coll_path, chapter_name in self._chapters(coll_path)
+                if skip is None or not skip(collection, chapter_name)
+            )
+        self._pack_chapters(chapters, jobs, desc="# Archiving")
         print("=" * 75)
 
-    def pack_all(self, source_dir):
+    def pack_all(self, source_dir, jobs=None):
         """Walks in directory and archives all"""
         if not os.path.exists(str(source_dir)):
             return
-        for dirname in tqdm(
-            os.listdir(source_dir), desc=f"## Packing {source_dir}", ascii=True
-        ):
-            imgs_path = os.path.join(source_dir, dirname)
-            if dirname == "." or os.path.isfile(imgs_path):
-                print("## Skipping file:", imgs_path)
+        self._pack_chapters(
+            self._chapters(source_dir), jobs, desc=f"## Packing {source_dir}"
+        )
+
+    def _chapters(self, source_dir):
+        chapters = []
+        for dirname in os.listdir(source_dir):
+            if dirname == "." or os.path.isfile(os.path.join(source_dir, dirname)):
                 continue
-            print("## Packing:", imgs_path)
+            chapters.append((source_dir, dirname))
+        return chapters
+
+    def _pack_chapters(self, chapters, jobs, desc):
+        """Packs chapters one by one, or fanned out on a pool of jobs workers.
+        Packing ZIP_STORED archives is all I/O and CRC, so threads are enough.
+        :param chapters: <list> (collection dir, chapter name) tuples
+        :param jobs: <int> Number of chapters packed at the same time
+        :param desc: <str> Progress bar description
+        :return: None
+        """
+        if not jobs or jobs <= 1:
+            for collection_dir, chapter_name in tqdm(chapters, desc=desc, ascii=True):
+                self.pack_chapter(collection_dir, chapter_name)
+            return
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="packer") as executor:
+            futures = {
+                executor.submit(self.pack_chapter, collection_dir, chapter_name): chapter_name
+                for collection_dir, chapter_name in chapters
+            }
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc=desc, ascii=True
+            ):
+                try:
+                    future.result()
+                except Exception as e:
+                    print("! Could not pack chapter {}: {}".format(futures[future], e))
+
+    def pack_chapter(self, collection_dir, chapter_name):
+        """Archives a single chapter, unless its archive is up to date
+        :param collection_dir: <str> Directory of the collection
+        :param chapter_name: <str> Name of the chapter (directory)
+        :return: <bool> True if the chapter was packed
+        """
+        imgs_path = os.path.join(collection_dir, chapter_name)
+        archive_path = self.archive_path(collection_dir, chapter_name)
+        state = self._chapter_state(imgs_path, archive_path)
+        if state is None:
+            return False
+        manifest = self._manifest(collection_dir)
+        with self._lock:
+            entry = manifest.get(chapter_name)
+        if self._is_up_to_date(entry, state, imgs_path):
+            return False
+        print("## Packing:", imgs_path)
+        if not self.pack(imgs_path, archive_path):
+            return False
+        entry = {
+            "dir": state["dir"],
+            "files": self._list_files(imgs_path),
+            "archive": self._stat(archive_path),
+        }
+        with self._lock:
+            manifest[chapter_name] = entry
+            self._save_manifest(collection_dir, manifest)
+        return True
+
+    def is_packed(self, collection_dir, chapter_name):
+        """Tells whether a chapter has an archive that is up to date with its directory
+        :param collection_dir: <str> Directory of the collection
+        :param chapter_name: <str> Name of the chapter (directory)
+        :return: <bool>
+        """
+        imgs_path = os.path.join(collection_dir, chapter_name)
+        state = self._chapter_state(imgs_path, self.archive_path(collection_dir, chapter_name))
+        if state is None or state["archive"] is None:
+            return False
+        manifest = self._manifest(collection_dir)
+        with self._lock:
+            entry = manifest.get(chapter_name)
+        return self._is_up_to_date(entry, state, imgs_path)
+
+    def _is_up_to_date(self, entry, state, imgs_path):
+        """An archive is up to date if neither it, nor its directory changed since packing.
+        The files are only listed when the directory changed (a file was added, removed or
+        renamed into place); pages are never rewritten in place.
+        """
+        if entry is None or entry.get("archive") != state["archive"]:
+            return False
+        if entry.get("dir") == state["dir"]:
+            return True
+        if entry.get("files") != self._list_files(imgs_path):
+            return False
+        entry["dir"] = state["dir"]
+        return True
+
+    def _chapter_state(self, imgs_path, archive_path):
+        if not os.path.isdir(imgs_path):
+            return None
+        return {"dir": os.stat(imgs_path).st_mtime_ns, "archive": self._stat(archive_path)}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _list_files(self, imgs_path):
+        return {os.path.basename(path): self._stat(path) for path in self.files(imgs_path)}
 
-            collection_name = os.path.basename(source_dir)
-            archive_path = os.path.join(source_dir, collection_name + " - " + dirname + ".cbz")
-            self.pack(imgs_path, archive_path)
+    def _manifest(self, collection_dir):
+        with self._lock:
+            if collection_dir not in self.manifests:
+                manifest = {}
+                manifest_path = os.path.join(collection_dir, self.MANIFEST_NAME)
+                if os.path.exists(manifest_path):
+                    try:
+                        with open(manifest_path) as f:
+                            manifest = json.load(f)
+                    except (OSError, ValueError) as e:
+                        print("! Could not read manifest, repacking:", manifest_path, e)
+                self.manifests[collection_dir] = manifest
+            return self.manifests[collection_dir]
+
+    def _save_manifest(self, collection_dir, manifest):
+        manifest_path = os.path.join(collection_dir, self.MANIFEST_NAME)
+        tmp_path = manifest_path + PART_SUFFIX
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def archive_path(collection_dir, chapter_name):
+        """Path of the archive of a chapter
+        :param collection_dir: <str> Directory of the collection
+        :param chapter_name: <str> Name of the chapter
+        :return: <str>
+        """
+        collection_name = os.path.basename(os.path.normpath(collection_dir))
+        return os.path.join(collection_dir, collection_name + " - " + chapter_name + ".cbz")
 
     def pack(self, imgs_path, archive_path):
         """Pack all the files in the file lists into the archive.
+        The archive is written next to its final path and renamed into place once complete,
+        so that a crash never leaves a half written archive behind.
         :param imgs_path: <str> Directory where the images are found
         :param archive_path: <str> Path of the new archive
-        :return: None
+        :return: <bool> True if the archive was created
         """
+        part_path = archive_path + PART_SUFFIX
         try:
-            zfile = zipfile.ZipFile(archive_path, "w")
+            zfile = zipfile.ZipFile(part_path, "w")
         except Exception as e:
             print("! Could not create archive: {}".format(archive_path))
             print("Error: ", e)
-            return
+            return False
         for i, path in enumerate(self.files(imgs_path)):
             try:
                 zfile.write(path, os.path.basename(path), zipfile.ZIP_STORED)
@@ -82,8 +240,71 @@ class Packer:
                 )
                 zfile.close()
                 try:
-                    os.remove(archive_path)
+                    os.remove(part_path)
                 except Exception:
                     pass
-                return
+                return False
         zfile.close()
+        os.replace(part_path, archive_path)
+        return True
+
+
+class ArchiveWriter:
+    """
+    ArchiveWriter streams pages straight into a chapter archive, without a staging directory.
+    Pages may arrive in any order; they are written in page order, holding back the ones that
+    arrive early. The archive only takes its final name once every page is in.
+    """
+
+    def __init__(self, archive_path, names):
+        """Initialize the ArchiveWriter object
+        :param archive_path: <str> Path of the finished archive
+        :param names: <list> Member names, in page order
+        :return: None
+        """
+        super().__init__()
+        self.archive_path = archive_path
+        self.part_path = archive_path + PART_SUFFIX
+        self.names = list(names)
+        self.written = 0
+        self.pending = {}
+        self._lock = threading.Lock()
+        self.zfile = zipfile.ZipFile(self.part_path, "w", zipfile.ZIP_STORED)
+
+    def add(self, name, data, member=None):
+        """Adds a page to the archive
+        :param name: <str> Name of the page, as given in names
+        :param data: <bytes> Contents of the page
+        :param member: <str> Member name in the archive, if not the name of the page
+        :return: None
+        """
+        with self._lock:
+            self.pending[name] = (member or name, data)
+            while self.written < len(self.names) and self.names[self.written] in self.pending:
+                member, data = self.pending.pop(self.names[self.written])
+                self.zfile.writestr(member, data, zipfile.ZIP_STORED)
+                self.written += 1
+
+    def missing(self):
+        with self._lock:
+            return [name for name in self.names[self.written:] if name not in self.pending]
+
+    def commit(self):
+        """Finishes the archive if every page made it in, discards it otherwise
+        :return: <bool> True if the archive was finished
+        """
+        missing = self.missing()
+        if missing:
+            print(f"! {len(missing)} pages missing, discarding: {self.archive_path}")
+            self.abort()
+            return False
+        self.zfile.close()
+        os.replace(self.part_path, self.archive_path)
+        return True
+
+    def abort(self):
+        self.zfile.close()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
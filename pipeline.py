@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class StageStats:
+    """
+    Occupancy and latency counters of a single pipeline stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_latency = 0.0
+        self.blocked = 0.0
+        self.occupancy_sum = 0
+        self.occupancy_samples = 0
+        self.started_at = time.monotonic()
+        self.stopped_at = None
+
+    def sample(self, occupancy):
+        self.occupancy_sum += occupancy
+        self.occupancy_samples += 1
+
+    def record(self, latency, ok=True):
+        self.processed += 1
+        if not ok:
+            self.failed += 1
+        self.busy += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    @property
+    def wall(self):
+        return (self.stopped_at or time.monotonic()) - self.started_at
+
+    @property
+    def utilization(self):
+        if self.wall <= 0:
+            return 0.0
+        return min(1.0, self.busy / self.wall)
+
+    @property
+    def mean_latency(self):
+        if self.processed == 0:
+            return 0.0
+        return self.busy / self.processed
+
+    @property
+    def mean_occupancy(self):
+        if self.occupancy_samples == 0:
+            return 0.0
+        return self.occupancy_sum / self.occupancy_samples
+
+
+class Stage:
+    """
+    Stage consumes items from its bounded input queue on its own thread.
+    Whatever the handler returns is handed to the next stage (None drops the item).
+    """
+
+    def __init__(self, name, handler, queue_size):
+        self.name = name
+        self.handler = handler
+        self.input = queue.Queue(maxsize=max(1, queue_size))
+        self.next = None
+        self.stats = StageStats(name)
+        self.thread = threading.Thread(
+            target=self._run, name=f"pipeline-{name}", daemon=True
+        )
+
+    def put(self, item, stats):
+        """Puts an item in the input queue, blocking while the queue is full
+        :param item: <object> The item to process
+        :param stats: <StageStats> Stats of the producer, charged with the blocked time
+        :return: None
+        """
+        start = time.monotonic()
+        self.input.put(item)
+        stats.blocked += time.monotonic() - start
+
+    def _run(self):
+        while True:
+            self.stats.sample(self.input.qsize())
+            item = self.input.get()
+            if item is _DONE:
+                break
+            start = time.monotonic()
+            ok = True
+            result = None
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                ok = False
+                print(f"!!! Exception in {self.name} stage:", e)
+            self.stats.record(time.monotonic() - start, ok=ok)
+            if self.next is not None and result is not None:
+                self.next.put(result, self.stats)
+        self.stats.stopped_at = time.monotonic()
+        if self.next is not None:
+            self.next.put(_DONE, self.stats)
+
+
+class Pipeline:
+    """
+    Pipeline chains stages through bounded queues so that all of them run at the same time.
+    A full queue blocks its producer, which keeps a slow stage from being flooded.
+    """
+
+    DEFAULT_QUEUE_SIZE = 2
+
+    def __init__(self, stages, queue_size=None, source="sweep"):
+        """Initialize the Pipeline object
+        :param stages: <list> (name, handler) tuples, in order
+        :param queue_size: <int> Capacity of every stage queue
+        :param source: <str> Name of the producer feeding the pipeline via submit
+        :return: None
+        """
+        super().__init__()
+        queue_size = queue_size or self.DEFAULT_QUEUE_SIZE
+        self.stages = [Stage(name, handler, queue_size) for name, handler in stages]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+        self.source = StageStats(source)
+        self._last_submit = None
+        self._closed = False
+
+    def start(self):
+        self.source.started_at = time.monotonic()
+        self._last_submit = self.source.started_at
+        for stage in self.stages:
+            stage.stats.started_at = self.source.started_at
+            stage.thread.start()
+        return self
+
+    def submit(self, item):
+        """Hands an item to the first stage. Blocks while the first stage is full.
+        :param item: <object> The item to process
+        :return: None
+        """
+        now = time.monotonic()
+        self.source.record(now - self._last_submit)
+        self.stages[0].put(item, self.source)
+        self._last_submit = time.monotonic()
+
+    def close(self):
+        """Waits for every submitted item to go through all stages
+        :return: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.source.stopped_at = time.monotonic()
+        self.stages[0].put(_DONE, self.source)
+        for stage in self.stages:
+            stage.thread.join()
+
+    def report(self):
+        print("-" * 75)
+        print("# Pipeline stages:")
+        all_stats = [self.source] + [stage.stats for stage in self.stages]
+        for stats in all_stats:
+            print(
+                f"## {stats.name:<10} items: {stats.processed:>4} (failed: {stats.failed})"
+                f" | busy: {stats.utilization:6.1%}"
+                f" | latency avg/max: {stats.mean_latency:6.2f}s/{stats.max_latency:6.2f}s"
+                f" | queue avg: {stats.mean_occupancy:4.1f}"
+                f" | blocked: {stats.blocked:6.2f}s"
+            )
+        bottleneck = max(all_stats, key=lambda s: s.utilization)
+        print("# Bottleneck stage:", bottleneck.name)
+        print("-" * 75)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+def load_proxies(path):
+    """Reads a proxy list: one proxy per line, blank lines and # comments are skipped
+    :param path: <str> Path of the file
+    :return: <list> The proxies as written
+    """
+    proxies = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                proxies.append(line)
+    return proxies
+
+
+class Proxy:
+    """
+    A proxy with its score: success rate and latency (moving average), and its circuit.
+    """
+
+    def __init__(self, address, latency=None):
+        self.url = address if "://" in address else "http://" + address
+        self.successes = 0
+        self.failures = 0
+        # consecutive failures, what the circuit breaker trips on
+        self.streak = 0
+        self.latency = latency
+        self.state = CLOSED
+        self.open_until = 0.0
+        # a half-open proxy is handed out to a single request at a time
+        self.on_trial = False
+
+    @property
+    def success_rate(self):
+        # starts at 1/2 rather than 0 or 1
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def weight(self, default_latency):
+        return self.success_rate / max(self.latency or default_latency, 0.05)
+
+    @property
+    def requests_proxies(self):
+        return {"http": self.url, "https": self.url}
+
+    @property
+    def playwright_proxy(self):
+        parsed = urlparse(self.url)
+        server = f"{parsed.scheme}://{parsed.hostname}"
+        if parsed.port is not None:
+            server += f":{parsed.port}"
+        proxy = {"server": server}
+        if parsed.username:
+            proxy["username"] = parsed.username
+            proxy["password"] = parsed.password or ""
+        return proxy
+
+    def __repr__(self):
+        return self.url
+
+
+class ProxyPool:
+    """
+    ProxyPool hands out proxies picked at random, weighted by success rate over latency.
+    Proxies are checked against check_url all at once on start up, then again every
+    check_interval seconds in the background. A proxy failing failure_threshold times in a
+    row is evicted (its circuit opens) for cooldown seconds; then a single request tries it
+    again, closing the circuit if it works.
+    """
+
+    DEFAULT_CHECK_URL = "https://httpbin.org/ip"
+    DEFAULT_CHECK_INTERVAL = 300
+    DEFAULT_CHECK_TIMEOUT = 10
+    DEFAULT_FAILURE_THRESHOLD = 3
+    DEFAULT_COOLDOWN = 120
+    # weight of the last sample in the latency average
+    ALPHA = 0.3
+
+    def __init__(
+        self,
+        proxies,
+        check_url=DEFAULT_CHECK_URL,
+        check_interval=DEFAULT_CHECK_INTERVAL,
+        check_timeout=DEFAULT_CHECK_TIMEOUT,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        cooldown=DEFAULT_COOLDOWN,
+        workers=16,
+    ):
+        """Initialize the ProxyPool object
+        :param proxies: <list> "host:port" or "scheme://[user:password@]host:port" proxies
+        :param check_url: <str> URL health checks fetch through every proxy
+        :param check_interval: <float> Seconds between background checks, 0 to only check on start
+        :param check_timeout: <float> Seconds a health check may take
+        :param failure_threshold: <int> Failures in a row opening the circuit of a proxy
+        :param cooldown: <float> Seconds an open proxy is left alone
+        :param workers: <int> Health checks run at the same time
+        :return: None
+        """
+        super().__init__()
+        self.proxies = [Proxy(address) for address in dict.fromkeys(proxies)]
+        self.check_url = check_url
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.workers = max(1, workers)
+        self.evictions = 0
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_options(cls, options, use_proxies=True):
+        """Creates a ProxyPool out of the "proxies" config
+        :param options: <dict> The "proxies" config
+        :param use_proxies: <bool> False when proxies are disabled (-n/--no-proxies)
+        :return: <ProxyPool> or None if there is no proxy to use
+        """
+        if not use_proxies or not options:
+            return None
+        proxies = list(options.get("list") or [])
+        if options.get("file"):
+            proxies += load_proxies(options["file"])
+        if not proxies:
+            return None
+        return cls(
+            proxies,
+            check_url=options.get("check_url", cls.DEFAULT_CHECK_URL),
+            check_interval=options.get("check_interval", cls.DEFAULT_CHECK_INTERVAL),
+            check_timeout=options.get("check_timeout", cls.DEFAULT_CHECK_TIMEOUT),
+            failure_threshold=options.get("failure_threshold", cls.DEFAULT_FAILURE_THRESHOLD),
+            cooldown=options.get("cooldown", cls.DEFAULT_COOLDOWN),
+        )
+
+    def start(self):
+        """Checks every proxy, then keeps checking them in the background
+        :return: <ProxyPool> self
+        """
+        if self._thread is not None:
+            return self
+        self.check_all()
+        self._thread = threading.Thread(target=self._check_periodically, name="proxy-checks", daemon=True)
+        self._thread.start()
+        return self
+
+    def _check_periodically(self):
+        if not self.check_interval:
+            return
+        while not self._stopped.wait(self.check_interval):
+            self.check_all()
+
+    def check_all(self):
+        print(f"# Checking {len(self.proxies)} proxies against {self.check_url} ...")
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(self.proxies))) as executor:
+            list(executor.map(self.check, self.proxies))
+        with self._condition:
+            available = len([proxy for proxy in self.proxies if proxy.state == CLOSED])
+        print(f"## {available}/{len(self.proxies)} proxies available")
+
+    def check(self, proxy):
+        """Fetches check_url through a proxy, scoring it
+        :param proxy: <Proxy>
+        :return: <bool> True if the proxy works
+        """
+        # only loaded when proxies are used, archiving stays light
+        import urllib.request
+
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler(proxy.requests_proxies))
+        started_at = time.monotonic()
+        try:
+            with opener.open(self.check_url, timeout=self.check_timeout) as r:
+                r.read()
+        except Exception:
+            self.record(proxy, False, check=True)
+            return False
+        self.record(proxy, True, time.monotonic() - started_at, check=True)
+        return True
+
+    def acquire(self):
+        """Picks a proxy, waiting for one whose circuit is not open
+        :return: <Proxy>
+        """
+        with self._condition:
+            while True:
+                now = time.time()
+                candidates = []
+                for proxy in self.proxies:
+                    if proxy.state == OPEN and proxy.open_until <= now:
+                        proxy.state = HALF_OPEN
+                    if proxy.state == CLOSED or (proxy.state == HALF_OPEN and not proxy.on_trial):
+                        candidates.append(proxy)
+                if candidates:
+                    proxy = random.choices(
+                        candidates, [proxy.weight(self.check_timeout) for proxy in candidates]
+                    )[0]
+                    if proxy.state == HALF_OPEN:
+                        proxy.on_trial = True
+                    return proxy
+                reopen = [proxy.open_until for proxy in self.proxies if proxy.state == OPEN]
+                self._condition.wait(max(0.1, min(reopen) - now) if reopen else None)
+
+    def record(self, proxy, ok, latency=None, check=False):
+        """Scores a request made through a proxy
+        :param proxy: <Proxy>
+        :param ok: <bool> True if the request went through
+        :param latency: <float> Seconds the request took
+        :param check: <bool> True for a health check, whose outcome opens or closes the
+            circuit right away
+        :return: None
+        """
+        with self._condition:
+            proxy.on_trial = False
+            if ok:
+                proxy.successes += 1
+                proxy.streak = 0
+                if latency is not None:
+                    proxy.latency = latency if proxy.latency is None else (
+                        self.ALPHA * latency + (1 - self.ALPHA) * proxy.latency
+                    )
+                if proxy.state == HALF_OPEN or (check and proxy.state == OPEN):
+                    proxy.state = CLOSED
+            else:
+                proxy.failures += 1
+                proxy.streak += 1
+                if proxy.state == HALF_OPEN or (
+                    proxy.state == CLOSED and (check or proxy.streak >= self.failure_threshold)
+                ):
+                    proxy.state = OPEN
+                    proxy.open_until = time.time() + self.cooldown
+                    self.evictions += 1
+            self._condition.notify_all()
+
+    def release(self, proxy):
+        """Gives back a proxy without scoring it, the request failed for another reason
+        :param proxy: <Proxy>
+        :return: None
+        """
+        with self._condition:
+            proxy.on_trial = False
+            self._condition.notify_all()
+
+    def report(self):
+        with self._condition:
+            proxies = sorted(self.proxies, key=lambda proxy: proxy.weight(self.check_timeout), reverse=True)
+            print("-" * 75)
+            print(f"# Proxies: {len(self.proxies)} | evictions: {self.evictions}")
+            for proxy in proxies:
+                latency = f"{proxy.latency:.2f}s" if proxy.latency is not None else "-"
+                print(
+                    f"## {proxy.url} | {proxy.state} | ok: {proxy.successes}, failed: {proxy.failures}"
+                    f" | latency: {latency}"
+                )
+            print("-" * 75)
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+THROTTLE_STATUSES = (429, 503)
+
+
+class TokenBucket:
+    """
+    TokenBucket hands out one token per request, refilling at `rate` tokens per second
+    up to `burst` tokens. The rate adapts: it is cut when the host pushes back and
+    recovers step by step while the host keeps answering.
+    """
+
+    BACKOFF_FACTOR = 0.5
+    RECOVERY_STEPS = 10
+
+    def __init__(self, rate, burst, min_rate):
+        """Initialize the TokenBucket object
+        :param rate: <float> Tokens per second. None or 0 means unlimited
+        :param burst: <int> Max tokens that can be stored
+        :param min_rate: <float> The rate is never cut below this
+        :return: None
+        """
+        super().__init__()
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_rate = min_rate
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return not self.max_rate
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.tokens = min(float(self.burst), self.tokens + elapsed * self.rate)
+
+    def reserve(self):
+        """Takes a token, even if it is not there yet
+        :return: <float> Seconds to wait before the token can be used
+        """
+        if self.unlimited:
+            return 0.0
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def slow_down(self, pause=None):
+        """Cuts the rate and optionally stops handing out tokens for a while
+        :param pause: <float> Seconds without tokens (e.g. from Retry-After)
+        :return: None
+        """
+        if self.unlimited:
+            return
+        self._refill(time.monotonic())
+        self.rate = max(self.min_rate, self.rate * self.BACKOFF_FACTOR)
+        self.tokens = min(self.tokens, 0.0)
+        if pause:
+            self.tokens = min(self.tokens, -pause * self.rate)
+
+    def speed_up(self):
+        if self.unlimited or self.rate >= self.max_rate:
+            return
+        self._refill(time.monotonic())
+        self.rate = min(self.max_rate, self.rate + self.max_rate / self.RECOVERY_STEPS)
+
+
+class RateLimiter:
+    """
+    RateLimiter keeps a token bucket for every host it sees.
+    Jitter is only added when a request actually has to wait for its token.
+    """
+
+    DEFAULT_RATE = 2.0
+    DEFAULT_BURST = 4
+    DEFAULT_JITTER = 0.5
+    DEFAULT_MIN_RATE = 0.05
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, jitter=DEFAULT_JITTER,
+                 min_rate=DEFAULT_MIN_RATE, hosts=None):
+        """Initialize the RateLimiter object
+        :param rate: <float> Requests per second for every host. None or 0 means unlimited
+        :param burst: <int> Requests that can go out at once after being idle
+        :param jitter: <float> Max random seconds added to a wait
+        :param min_rate: <float> Lowest rate a host can be slowed down to
+        :param hosts: <dict> Host specific {"rate", "burst"} overrides
+        :return: None
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.min_rate = min_rate
+        self.hosts = hosts or {}
+        self.buckets = {}
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, options):
+        """Creates a RateLimiter out of a variant's "rate_limit" config
+        :param options: <dict> The "rate_limit" config or None for the defaults
+        :return: <RateLimiter>
+        """
+        options = options or {}
+        return cls(
+            rate=options.get("rate", cls.DEFAULT_RATE),
+            burst=options.get("burst", cls.DEFAULT_BURST),
+            jitter=options.get("jitter", cls.DEFAULT_JITTER),
+            min_rate=options.get("min_rate", cls.DEFAULT_MIN_RATE),
+            hosts=options.get("hosts"),
+        )
+
+    def _bucket(self, url):
+        host = urlparse(url).netloc or url
+        if host not in self.buckets:
+            host_options = self.hosts.get(host) or {}
+            self.buckets[host] = TokenBucket(
+                rate=host_options.get("rate", self.rate),
+                burst=host_options.get("burst", self.burst),
+                min_rate=self.min_rate,
+            )
+        return self.buckets[host]
+
+    def acquire(self, url):
+        """Blocks until a request towards the host of the url is allowed
+        :param url: <str> The url about to be requested
+        :return: <float> Seconds waited
+        """
+        with self._lock:
+            wait = self._bucket(url).reserve()
+        if wait <= 0:
+            return 0.0
+        if self.jitter:
+            wait += random.uniform(0, self.jitter)
+        with self._lock:
+            self.waited += wait
+        time.sleep(wait)
+        return wait
+
+    def penalize(self, url, retry_after=None):
+        """The host pushed back (429/503). Slows it down.
+        :param url: <str> The url that was throttled
+        :param retry_after: <float> Seconds the host asked us to wait
+        :return: None
+        """
+        with self._lock:
+            self._bucket(url).slow_down(pause=retry_after)
+
+    def reward(self, url):
+        with self._lock:
+            self._bucket(url).speed_up()
+
+    def feedback(self, url, status_code, retry_after=None):
+        """Adapts the host rate to the status of a response
+        :param url: <str> The requested url
+        :param status_code: <int> HTTP status of the response
+        :param retry_after: <float> Seconds the host asked us to wait
+        :return: None
+        """
+        if status_code in THROTTLE_STATUSES:
+            self.penalize(url, retry_after)
+        elif status_code is not None and status_code < 400:
+            self.reward(url)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from enum import Enum
+
+
+class Outcome(Enum):
+    OK = 1
+    RETRY = 2
+    RESET = 3
+    FATAL = 4
+
+
+class RetryStats:
+    """
+    Counters of everything that did not work on the first try
+    """
+
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        self.resets = 0
+        self.fatal = 0
+        self.exhausted = 0
+        self.wasted = 0.0
+        self.succeeded = 0
+        self.first_try = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def report(self):
+        print("-" * 75)
+        print("# Retries:")
+        print(f"## Attempts: {self.attempts} | retries: {self.retries} | resets: {self.resets}")
+        if self.succeeded:
+            print(
+                f"## Succeeded: {self.succeeded}, {self.first_try / self.succeeded:.1%} on the first try"
+                f" | latency: {self.latency / self.succeeded:.2f}s avg, {self.max_latency:.2f}s max"
+            )
+        print(f"## Given up: {self.fatal} fatal, {self.exhausted} out of budget")
+        print(f"## Time wasted on failures and backoff: {self.wasted:.2f}s")
+        print("-" * 75)
+
+
+class RetryPolicy:
+    """
+    RetryPolicy decides what to do after a failure: retry, reset the session first or give up.
+    Retries back off exponentially (with jitter), unless the server said how long to wait.
+    Every key (URL) has a budget of failed attempts for the whole run: a success gives its
+    attempt back, so a URL fetched again and again is never skipped.
+    """
+
+    FATAL_STATUSES = (400, 401, 404, 405, 410, 451)
+    RESET_STATUSES = (403,)
+    RESET_EXCEPTIONS = (LookupError,)
+    RETRY_EXCEPTIONS = ("TimeoutError", "Timeout", "ReadTimeout", "ConnectTimeout",
+                        "ConnectionError", "ChunkedEncodingError", "ProtocolError")
+
+    DEFAULT_MAX_ATTEMPTS = 10
+    DEFAULT_BASE_DELAY = 1.0
+    DEFAULT_MAX_DELAY = 60.0
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY):
+        """Initialize the RetryPolicy object
+        :param max_attempts: <int> Failed attempts allowed per key for the whole run
+        :param base_delay: <float> Backoff of the first retry, in seconds
+        :param max_delay: <float> Max backoff, in seconds
+        :return: None
+        """
+        super().__init__()
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = RetryStats()
+        self.spent = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, options):
+        """Creates a RetryPolicy out of the "retry" config
+        :param options: <dict> The "retry" config or None for the defaults
+        :return: <RetryPolicy>
+        """
+        options = options or {}
+        return cls(
+            max_attempts=options.get("max_attempts", cls.DEFAULT_MAX_ATTEMPTS),
+            base_delay=options.get("base_delay", cls.DEFAULT_BASE_DELAY),
+            max_delay=options.get("max_delay", cls.DEFAULT_MAX_DELAY),
+        )
+
+    def classify_status(self, status_code):
+        if status_code < 400:
+            return Outcome.OK
+        if status_code in self.RESET_STATUSES:
+            return Outcome.RESET
+        if status_code in self.FATAL_STATUSES:
+            return Outcome.FATAL
+        return Outcome.RETRY
+
+    def classify_exception(self, exc):
+        if isinstance(exc, self.RESET_EXCEPTIONS):
+            return Outcome.RESET
+        if isinstance(exc, OSError) or type(exc).__name__ in self.RETRY_EXCEPTIONS:
+            # requests' exceptions are OSErrors as well
+            return Outcome.RETRY
+        return Outcome.FATAL
+
+    @staticmethod
+    def retry_after(response):
+        """Reads the Retry-After header (seconds or HTTP date) of a response
+        :param response: <Response>
+        :return: <float> Seconds to wait or None
+        """
+        value = response.headers.get("Retry-After") if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before the next attempt
+        :param attempt: <int> Number of failed attempts so far (from 1)
+        :param retry_after: <float> Seconds the server asked us to wait
+        :return: <float>
+        """
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(ceiling / 2, ceiling)
+
+    def start(self, key):
+        """Starts retrying an operation
+        :param key: <str> What the budget is kept for, usually the URL
+        :return: <RetryState>
+        """
+        return RetryState(self, key)
+
+    def _take(self, key):
+        with self._lock:
+            if self.spent.get(key, 0) >= self.max_attempts:
+                return False
+            self.spent[key] = self.spent.get(key, 0) + 1
+            self.stats.attempts += 1
+            return True
+
+    def _record_success(self, key, attempts, latency):
+        with self._lock:
+            # only failures count against the budget
+            if self.spent.get(key, 0) > 1:
+                self.spent[key] -= 1
+            else:
+                self.spent.pop(key, None)
+            self.stats.succeeded += 1
+            if attempts == 1:
+                self.stats.first_try += 1
+            self.stats.latency += latency
+            self.stats.max_latency = max(self.stats.max_latency, latency)
+
+    def _record(self, outcome, wasted, exhausted=False):
+        with self._lock:
+            self.stats.wasted += wasted
+            if outcome is Outcome.FATAL:
+                self.stats.fatal += 1
+            elif exhausted:
+                self.stats.exhausted += 1
+            elif outcome is Outcome.RESET:
+                self.stats.resets += 1
+                self.stats.retries += 1
+            else:
+                self.stats.retries += 1
+
+
+class RetryState:
+    """
+    RetryState follows the attempts of one operation:
+        retry = policy.start(url)
+        for attempt in retry:
+            ...
+            if ok:
+                retry.succeeded()
+                break
+            if not retry.failed(outcome, retry_after):
+                break
+    """
+
+    def __init__(self, policy, key):
+        self.policy = policy
+        self.key = key
+        self.attempt = 0
+        self.started_at = None
+        self.first_started_at = None
+
+    def __iter__(self):
+        while self.policy._take(self.key):
+            self.attempt += 1
+            self.started_at = time.monotonic()
+            if self.first_started_at is None:
+                self.first_started_at = self.started_at
+            yield self.attempt
+
+    def succeeded(self):
+        """Records the success of the operation: how many attempts and how long it took,
+        backoff included
+        :return: None
+        """
+        self.policy._record_success(self.key, self.attempt, time.monotonic() - self.first_started_at)
+
+    def failed(self, outcome, retry_after=None):
+        """Records a failed attempt and backs off if it is worth retrying
+        :param outcome: <Outcome> Classification of the failure
+        :param retry_after: <float> Seconds the server asked us to wait
+        :return: <bool> True if another attempt should follow
+        """
+        wasted = time.monotonic() - self.started_at if self.started_at else 0.0
+        if outcome is Outcome.FATAL:
+            self.policy._record(outcome, wasted)
+            return False
+        if self.policy.spent.get(self.key, 0) >= self.policy.max_attempts:
+            self.policy._record(outcome, wasted, exhausted=True)
+            return False
+        delay = self.policy.delay(self.attempt, retry_after)
+        self.policy._record(outcome, wasted + delay)
+        time.sleep(delay)
+        return True
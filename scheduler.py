@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class Scheduler:
+    """
+    Scheduler runs jobs (series) on a fixed number of threads, with a cap on the jobs running
+    against the same site. Sites take turns: a worker picks the job of the next site in line
+    that is below its cap, so a site with many series never starves the others.
+    A failing job is reported and the others go on.
+    """
+
+    DEFAULT_WORKERS = 1
+    DEFAULT_PER_SITE = 1
+
+    def __init__(self, workers=DEFAULT_WORKERS, per_site=DEFAULT_PER_SITE):
+        """Initialize the Scheduler object
+        :param workers: <int> Max jobs running at the same time
+        :param per_site: <int> Max jobs running at the same time against the same site
+        :return: None
+        """
+        super().__init__()
+        self.workers = max(1, workers or self.DEFAULT_WORKERS)
+        self.per_site = max(1, per_site or self.DEFAULT_PER_SITE)
+        self.queues = OrderedDict()
+        self.running = {}
+        self.done = []
+        self.failed = []
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_options(cls, options, workers=None):
+        """Creates a Scheduler out of the "scheduler" config
+        :param options: <dict> The "scheduler" config
+        :param workers: <int> Overrides the configured workers
+        :return: <Scheduler>
+        """
+        options = options or {}
+        return cls(
+            workers=workers or options.get("workers", cls.DEFAULT_WORKERS),
+            per_site=options.get("per_site", cls.DEFAULT_PER_SITE),
+        )
+
+    def add(self, site, name, fn, *args):
+        """Queues a job
+        :param site: <str> What the per site cap is kept for
+        :param name: <str> Name of the job, for the report
+        :param fn: <callable> The job, called as fn(*args)
+        :return: None
+        """
+        with self._condition:
+            self.queues.setdefault(site, deque()).append((name, fn, args))
+            self.running.setdefault(site, 0)
+
+    def _next(self):
+        """Waits for a job that can run, rotating the sites so that they take turns
+        :return: <tuple> (site, name, fn, args) or None once every job was handed out
+        """
+        with self._condition:
+            while True:
+                pending = False
+                for site in list(self.queues):
+                    jobs = self.queues[site]
+                    if not jobs:
+                        continue
+                    pending = True
+                    if self.running[site] >= self.per_site:
+                        continue
+                    # the site goes to the back of the line
+                    self.queues.move_to_end(site)
+                    self.running[site] += 1
+                    return (site,) + jobs.popleft()
+                if not pending:
+                    return None
+                self._condition.wait()
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            site, name, fn, args = job
+            started_at = time.monotonic()
+            try:
+                fn(*args)
+                result = (name, time.monotonic() - started_at)
+                failed = False
+            except Exception as e:
+                print(f"!!! Series failed, going on with the others: {name} - {e}")
+                result = (name, e)
+                failed = True
+            with self._condition:
+                self.running[site] -= 1
+                (self.failed if failed else self.done).append(result)
+                self._condition.notify_all()
+
+    def run(self):
+        """Runs every queued job and waits for all of them
+        :return: None
+        """
+        if self.workers == 1:
+            self._work()
+            return
+        threads = [
+            threading.Thread(target=self._work, name=f"series-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def report(self):
+        print("-" * 75)
+        print(f"# Series: {len(self.done)} done, {len(self.failed)} failed")
+        for name, error in self.failed:
+            print(f"## Failed: {name} - {error}")
+        print("-" * 75)
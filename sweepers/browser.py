@@ -0,0 +1,465 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlparse
+
+from images import PART_SUFFIX
+
+PAGE_TIMEOUT = 300 * 1000  # 5 min expressed in milliseconds
+
+# browsers grow with every page they load, they are restarted after this many navigations
+DEFAULT_MAX_NAVIGATIONS = 200
+
+# what a headless sweep does not need to download
+HEADLESS_BLOCKED_RESOURCES = ["image", "media", "font"]
+
+
+# anti-bot interstitials
+CHALLENGE_MARKERS = ("challenge-platform", "cf-chl", "cf_chl_opt", "Just a moment...", "Attention Required!")
+
+
+def site_of(url):
+    """Roughly the registrable domain of an URL (last two labels of the host)"""
+    host = urlparse(url).hostname or ""
+    return ".".join(host.split(".")[-2:])
+
+
+def cookie_site(cookie):
+    return site_of("http://" + cookie["domain"].lstrip("."))
+
+
+def is_challenge_html(html):
+    html = html[:64 * 1024]
+    return any(marker in html for marker in CHALLENGE_MARKERS)
+
+
+class StorageState:
+    """
+    StorageState keeps the cookies and local storage of every site on disk, one file per site,
+    so that new browser contexts start with the clearance and consent of the previous runs.
+    A state expires after ttl seconds and is dropped as soon as a challenge shows up again.
+    """
+
+    DEFAULT_PATH = ".browser-state"
+    DEFAULT_TTL = 12 * 3600
+
+    def __init__(self, root=DEFAULT_PATH, ttl=DEFAULT_TTL):
+        """Initialize the StorageState object
+        :param root: <str> Directory of the state files
+        :param ttl: <int> Seconds a state stays valid
+        :return: None
+        """
+        super().__init__()
+        self.root = root
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, browser_options):
+        """Creates a StorageState out of the "browser" config
+        :param browser_options: <dict> The "browser" config
+        :return: <StorageState> or None if states are not to be kept
+        """
+        browser_options = browser_options or {}
+        if not browser_options.get("persist_state", True):
+            return None
+        return cls(
+            root=browser_options.get("state_path", cls.DEFAULT_PATH),
+            ttl=browser_options.get("state_ttl", cls.DEFAULT_TTL),
+        )
+
+    def _path(self, site):
+        return os.path.join(self.root, site + ".json")
+
+    def load(self):
+        """Merges the states of every site that did not expire
+        :return: <dict> Playwright storage state (cookies & origins)
+        """
+        state = {"cookies": [], "origins": []}
+        with self._lock:
+            for file_name in os.listdir(self.root):
+                path = os.path.join(self.root, file_name)
+                if not file_name.endswith(".json"):
+                    continue
+                try:
+                    with open(path) as f:
+                        site_state = json.load(f)
+                except (OSError, ValueError) as e:
+                    print("!!! Could not read browser state, dropping it:", path, e)
+                    site_state = {}
+                if time.time() - site_state.get("saved_at", 0) > self.ttl:
+                    os.remove(path)
+                    continue
+                state["cookies"].extend(site_state.get("cookies", []))
+                state["origins"].extend(site_state.get("origins", []))
+        return state
+
+    def save(self, url, state):
+        """Keeps the part of a context state that belongs to the site of an URL
+        :param url: <str> Any URL of the site
+        :param state: <dict> Playwright storage state of the context
+        :return: None
+        """
+        site = site_of(url)
+        site_state = {
+            "saved_at": time.time(),
+            "cookies": [
+                cookie for cookie in state.get("cookies", []) if cookie_site(cookie) == site
+            ],
+            "origins": [
+                origin for origin in state.get("origins", []) if site_of(origin["origin"]) == site
+            ],
+        }
+        path = self._path(site)
+        with self._lock:
+            with open(path + PART_SUFFIX, "w") as f:
+                json.dump(site_state, f)
+            os.replace(path + PART_SUFFIX, path)
+
+    def invalidate(self, url):
+        path = self._path(site_of(url))
+        with self._lock:
+            if os.path.exists(path):
+                print("- Challenge detected, dropping the stored browser state of", site_of(url))
+                os.remove(path)
+
+
+class BrowserSession:
+    """
+    BrowserSession is a browser with its own context (cookies, storage, stealth) and page.
+    Playwright is not thread safe: a session must only be used by the thread that started it.
+    Headless sessions abort images, media, fonts and third party requests by default,
+    as the sweepers only read the page markup.
+    The browser is relaunched when it crashes and after max_navigations page loads.
+    """
+
+    def __init__(self, browser_options=None, storage=None, proxy_pool=None):
+        """Initialize the BrowserSession object
+        :param browser_options: <dict> The "browser" config
+        :param storage: <StorageState> Where contexts load and save their cookies & storage
+        :param proxy_pool: <ProxyPool> Every new context goes through one of its proxies
+        :return: None
+        """
+        super().__init__()
+        self.browser_options = browser_options or {}
+        self.storage = storage
+        self.proxy_pool = proxy_pool
+        self.proxy = None
+        self.playwright_context = None
+        self.playwright = None
+        self.browser = None
+        self.context = None
+        self.page = None
+        self.headless = bool(self.browser_options.get("headless", False))
+        default_blocked = HEADLESS_BLOCKED_RESOURCES if self.headless else []
+        self.blocked_resources = set(self.browser_options.get("block_resources", default_blocked))
+        self.block_third_party = bool(self.browser_options.get("block_third_party", self.headless))
+        # capturing keeps the images the page loads, so they must not be blocked
+        self.capture = bool(self.browser_options.get("capture", False))
+        if self.capture:
+            self.blocked_resources.discard("image")
+        self.captured = {}
+        self.first_party = None
+        self.allowed_hosts = set()
+        self.blocked = 0
+        self.max_navigations = self.browser_options.get("max_navigations", DEFAULT_MAX_NAVIGATIONS)
+        self.navigations = 0
+
+    @property
+    def blocks_images(self):
+        return "image" in self.blocked_resources
+
+    def start(self):
+        if self.playwright_context is None:
+            # playwright is only loaded once a browser is needed
+            from playwright.sync_api import sync_playwright
+
+            self.playwright_context = sync_playwright()
+            self.playwright = self.playwright_context.start()
+        self._launch()
+
+    def _launch(self):
+        if self.browser is not None and not self.browser.is_connected():
+            print("- Browser crashed, relaunching...")
+            self.browser = None
+        if self.browser is None:
+            self.browser = self.playwright.webkit.launch(headless=self.headless)
+            self.navigations = 0
+            self.context = None
+            self.page = None
+        if self.context is None:
+            context_options = {}
+            if self.storage is not None:
+                context_options["storage_state"] = self.storage.load()
+            if self.proxy_pool is not None:
+                self.proxy = self.proxy_pool.acquire()
+                context_options["proxy"] = self.proxy.playwright_proxy
+                print("- Browsing through proxy:", self.proxy)
+            self.context = self.browser.new_context(**context_options)
+            if self.blocked_resources or self.block_third_party:
+                self.context.route("**/*", self._route)
+            self.page = None
+        if self.page is None:
+            from playwright_stealth import stealth_sync
+
+            self.page = self.context.new_page()
+            stealth_sync(self.page)
+            if self.capture:
+                self.page.on("response", self._on_response)
+
+    def _should_block(self, request):
+        if request.resource_type == "document" and request.frame.parent_frame is None:
+            # never block the page itself
+            return False
+        host = urlparse(request.url).hostname or ""
+        if host in self.allowed_hosts:
+            return False
+        if request.resource_type in self.blocked_resources:
+            return True
+        if self.capture and request.resource_type == "image":
+            # the pages are usually served by a CDN
+            return False
+        return self.block_third_party and site_of(request.url) != self.first_party
+
+    def _route(self, route):
+        if self._should_block(route.request):
+            self.blocked += 1
+            route.abort()
+        else:
+            route.continue_()
+
+    def _on_response(self, response):
+        if response.request.resource_type == "image" and response.ok:
+            self.captured[response.url] = response
+
+    def captured_body(self, url):
+        """The body of an image the current page loaded
+        :param url: <str> URL of the image
+        :return: <bytes> or None if the page did not load it
+        """
+        response = self.captured.get(url)
+        if response is None:
+            return None
+        try:
+            return response.body()
+        except Exception:
+            return None
+
+    def recycle(self):
+        """Throws away the context (and the browser if it crashed), starting over clean
+        :return: None
+        """
+        print("- Recycling browser page...")
+        try:
+            if self.context is not None:
+                self.context.close()
+        except Exception as e:
+            print("!!! Exception while closing browser context:", e)
+        self.context = None
+        self.page = None
+        self._release_proxy()
+
+    def _release_proxy(self):
+        # the next context picks a proxy again
+        if self.proxy is not None:
+            self.proxy_pool.release(self.proxy)
+            self.proxy = None
+
+    def get_page(self, url, locator=None, rate_limiter=None, allowed_hosts=None):
+        """Navigates the page of the session
+        :param url: <str> URL of the page
+        :param locator: <str> Selector to wait for
+        :param rate_limiter: <RateLimiter> Told about the status of the response
+        :param allowed_hosts: <list> Hosts whose requests are never blocked
+        :return: <Page>
+        """
+        loaded = False
+        try:
+            if self.max_navigations and self.navigations >= self.max_navigations:
+                print(f"- {self.navigations} navigations, restarting the browser...")
+                self._close_browser()
+            self._launch()
+            self.navigations += 1
+            self.first_party = site_of(url)
+            self.allowed_hosts = set(allowed_hosts or [])
+            blocked = self.blocked
+            self.captured = {}
+            print("- Navigating to URL:", url)
+            started_at = time.monotonic()
+            response = self.page.goto(url=url, timeout=PAGE_TIMEOUT)
+            loaded = True
+            if self.proxy is not None:
+                self.proxy_pool.record(self.proxy, True, time.monotonic() - started_at)
+            if response is not None and rate_limiter is not None:
+                rate_limiter.feedback(url, response.status)
+            if self.storage is not None and is_challenge_html(self.page.content()):
+                self.storage.invalidate(url)
+
+            if self.page.url != url:
+                print("- Detected url change!")
+                print("- Waiting for page to load...")
+                self.page.wait_for_load_state(state="load", timeout=PAGE_TIMEOUT)
+                print("- Checking for captcha...")
+                self.page.wait_for_timeout(1500)
+
+            print("- Waiting for URL...")
+            self.page.wait_for_url(url=url, timeout=PAGE_TIMEOUT)
+            print("- Waiting for page to load...")
+            self.page.wait_for_load_state(state="load", timeout=PAGE_TIMEOUT)
+
+            if locator:
+                self.page.wait_for_selector(locator, timeout=PAGE_TIMEOUT)
+                self.page.locator(locator).focus()
+
+            if self.blocked > blocked:
+                print(f"- Blocked {self.blocked - blocked} requests.")
+            print("- Page loaded correctly.")
+            return self.page
+        except Exception as e:
+            print("!!! Exception while getting page:", e)
+            if self.proxy is not None and not loaded:
+                self.proxy_pool.record(self.proxy, False)
+            self.recycle()
+            raise ConnectionError(f"Could not load page: {url}") from e
+
+    def save_state(self, url):
+        """Stores the cookies & storage of the site of an URL, after a successful sweep
+        :param url: <str> Any URL of the site
+        :return: None
+        """
+        if self.storage is None or self.context is None:
+            return
+        try:
+            self.storage.save(url, self.context.storage_state())
+        except Exception as e:
+            print("!!! Exception while saving browser state:", e)
+
+    def clearance(self, url):
+        """The cookies the context holds for the site of an URL and the user agent they were
+        issued to, as anti-bot clearance is bound to it
+        :param url: <str> Any URL of the site
+        :return: <tuple> (cookies, user agent)
+        """
+        site = site_of(url)
+        cookies = [cookie for cookie in self.context.cookies() if cookie_site(cookie) == site]
+        return cookies, self.page.evaluate("navigator.userAgent")
+
+    def _close_browser(self):
+        try:
+            if self.browser is not None:
+                self.browser.close()
+        except Exception as e:
+            print("!!! Exception while closing browser:", e)
+        self.browser = None
+        self.context = None
+        self.page = None
+        self._release_proxy()
+
+    def close(self):
+        self._close_browser()
+        try:
+            if self.playwright is not None:
+                self.playwright.stop()
+        except Exception as e:
+            print("!!! Exception while stopping playwright:", e)
+        self.playwright_context = None
+        self.playwright = None
+
+
+class BrowserPool:
+    """
+    BrowserPool runs tasks on a fixed number of threads, each one owning a BrowserSession.
+    A task failing with an exception gets its session recycled; the other workers go on.
+    A pool outlives the sweepers it is leased to, so browsers (and their clearance cookies)
+    are started once per run.
+    """
+
+    @classmethod
+    def from_options(cls, browser_options, proxy_pool=None):
+        """Creates a BrowserPool out of the "browser" config
+        :param browser_options: <dict> The "browser" config
+        :param proxy_pool: <ProxyPool> Proxies of the browser contexts
+        :return: <BrowserPool>
+        """
+        browser_options = browser_options or {}
+        return cls(
+            size=browser_options.get("pool_size", 1),
+            browser_options=browser_options,
+            proxy_pool=proxy_pool,
+        )
+
+    def __init__(self, size=1, browser_options=None, proxy_pool=None):
+        """Initialize the BrowserPool object
+        :param size: <int> Number of browser sessions (and threads)
+        :param browser_options: <dict> The "browser" config
+        :param proxy_pool: <ProxyPool> Proxies of the browser contexts
+        :return: None
+        """
+        super().__init__()
+        self.size = max(1, size or 1)
+        self.browser_options = browser_options or {}
+        self.proxy_pool = proxy_pool
+        self.storage = StorageState.from_options(self.browser_options)
+        self.tasks = queue.Queue()
+        self.threads = []
+        self._local = threading.local()
+
+    def start(self):
+        if self.threads:
+            return self
+        for i in range(self.size):
+            thread = threading.Thread(target=self._work, name=f"browser-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def _work(self):
+        session = BrowserSession(self.browser_options, self.storage, self.proxy_pool)
+        self._local.session = session
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    break
+                future, fn, args = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    session.start()
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    session.recycle()
+                    future.set_exception(e)
+        finally:
+            session.close()
+
+    def current(self):
+        """The session of the calling worker thread
+        :return: <BrowserSession>
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            raise RuntimeError("Browser pages can only be used from a browser pool task")
+        return session
+
+    def submit(self, fn, *args):
+        """Runs fn(*args) on one of the workers
+        :return: <Future>
+        """
+        future = Future()
+        self.tasks.put((future, fn, args))
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def close(self):
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
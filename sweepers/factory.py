@@ -1,23 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import importlib
+
 from variant import Variant
-from sweepers.sweeper_mt import SweeperMT
-from sweepers.sweeper_ma import SweeperMA
-from sweepers.sweeper_to import SweeperTO
 
 
 class SweeperFactory:
     """
     Sweeper can collect chapters, scrape chapter URL and get images
     All will be archived in a temp dir named: archives
+    Sweepers are registered as "module:Class" and only imported when first created, so that
+    their network and browser dependencies are not loaded by runs that do not sweep.
     """
 
     RETRY = 50
+    SWEEPERS = {
+        Variant.TO: "sweepers.sweeper_to:SweeperTO",
+        Variant.MA: "sweepers.sweeper_ma:SweeperMA",
+        Variant.MT: "sweepers.sweeper_mt:SweeperMT",
+    }
 
-    def __init__(self, main_url, dry_run, filters, start_from, reverse=False, use_proxies=True):
+    def __init__(self, main_url, dry_run, filters, start_from, reverse=False, use_proxies=True, rate_limiter=None,
+                 retry_policy=None, browser_options=None, allowed_hosts=None, browser_pool=None):
         """Initialize the Collector object
         :param main_url: <str> The URL from which to collect chapters and other info
         :param dry_run: <bool> Will only print and not download
+        :param rate_limiter: <RateLimiter> Per host politeness policy of the variant
+        :param retry_policy: <RetryPolicy> Retry policy shared with the downloader
+        :param browser_options: <dict> The "browser" config
+        :param allowed_hosts: <list> Hosts the browser never blocks requests to
+        :param browser_pool: <BrowserPool> Browsers shared by all the sweepers of the run
         :return: None
         """
         super().__init__()
@@ -31,31 +43,39 @@ class SweeperFactory:
         self.filters = filters
         self.scraper = None
         self.start_from = start_from
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.browser_options = browser_options
+        self.allowed_hosts = allowed_hosts
+        self.browser_pool = browser_pool
+
+    @classmethod
+    def register(cls, variant, path):
+        """Registers the sweeper of a variant
+        :param variant: <Variant>
+        :param path: <str> "module:Class" of the sweeper
+        :return: None
+        """
+        cls.SWEEPERS[variant] = path
+
+    @classmethod
+    def sweeper_class(cls, variant):
+        if variant not in cls.SWEEPERS:
+            raise ValueError(f"No sweeper registered for: {variant}")
+        module_name, _, class_name = cls.SWEEPERS[variant].partition(":")
+        return getattr(importlib.import_module(module_name), class_name)
 
     def create_sweeper(self, variant):
-        if variant == Variant.TO:
-            return SweeperTO(
-                main_url=self.main_url,
-                dry_run=self.dry_run,
-                filters=self.filters,
-                reverse=self.reverse,
-                use_proxies=self.use_proxies,
-            )
-        elif variant == Variant.MA:
-            return SweeperMA(
-                main_url=self.main_url,
-                dry_run=self.dry_run,
-                filters=self.filters,
-                reverse=self.reverse,
-                start_from=self.start_from,
-                use_proxies=self.use_proxies,
-            )
-        elif variant == Variant.MT:
-            return SweeperMT(
-                main_url=self.main_url,
-                dry_run=self.dry_run,
-                filters=self.filters,
-                reverse=self.reverse,
-                start_from=self.start_from,
-                use_proxies=self.use_proxies,
-            )
+        return self.sweeper_class(variant)(
+            main_url=self.main_url,
+            dry_run=self.dry_run,
+            filters=self.filters,
+            reverse=self.reverse,
+            start_from=self.start_from,
+            use_proxies=self.use_proxies,
+            rate_limiter=self.rate_limiter,
+            retry_policy=self.retry_policy,
+            browser_options=self.browser_options,
+            allowed_hosts=self.allowed_hosts,
+            browser_pool=self.browser_pool,
+        )
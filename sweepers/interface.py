@@ -1,10 +1,91 @@
+import itertools
 import os
-from playwright.sync_api import sync_playwright
-from playwright_stealth import stealth_sync
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from urllib.parse import urljoin
+
+from tqdm import tqdm
 
 import cloudscraper
+from bs4 import BeautifulSoup
+
+import helpers
+import images
+from retry import Outcome, RetryPolicy
+from sweepers.browser import PAGE_TIMEOUT, BrowserPool, is_challenge_html
+
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+HTTP_TIMEOUT = (30, 60)
+
+# anti-bot interstitials a plain HTTP client can not get through
+CHALLENGE_STATUSES = (403, 429, 503)
+
+# attributes lazy loaders keep the real URL of a page in
+IMG_ATTRIBUTES = ("data-src", "data-original", "data-lazy-src")
+
+
+def img_url(img, base_url):
+    """Finds the URL of a page in a parsed <img>, mirroring EXTRACT_IMG_JS
+    :param img: <Tag> The <img> element
+    :param base_url: <str> URL of the document, relative URLs are resolved against it
+    :return: <str> or None if the page has no URL yet
+    """
+    candidates = [img.get(attribute) for attribute in IMG_ATTRIBUTES]
+    srcset = img.get("srcset") or img.get("data-srcset")
+    if srcset:
+        # the last candidate is the largest one
+        candidates.append(srcset.split(",")[-1].strip().split(" ")[0])
+    candidates.append(img.get("src"))
+    for candidate in candidates:
+        value = (candidate or "").strip()
+        if value and not value.startswith("data:"):
+            return urljoin(base_url, value)
+    return None
+
+
+def is_challenge(response):
+    if response.status_code in CHALLENGE_STATUSES and "cf-ray" in {k.lower() for k in response.headers}:
+        return True
+    return is_challenge_html(response.text)
+
+
+# how long the lazy loaders get to settle after the scroll
+NETWORK_IDLE_TIMEOUT = 10 * 1000
 
-PAGE_TIMEOUT = 300 * 1000  # 5 min expressed in milliseconds
+# reads the URL of a page: lazy loaders keep the real URL in data-* attributes, src may
+# still be a placeholder
+EXTRACT_IMG_JS = """
+(img) => {
+    const candidates = [
+        img.getAttribute("data-src"),
+        img.getAttribute("data-original"),
+        img.getAttribute("data-lazy-src"),
+    ];
+    const srcset = img.getAttribute("srcset") || img.getAttribute("data-srcset");
+    if (srcset) {
+        // the last candidate is the largest one
+        candidates.push(srcset.split(",").pop().trim().split(/\\s+/)[0]);
+    }
+    candidates.push(img.getAttribute("src"));
+    for (const candidate of candidates) {
+        const value = (candidate || "").trim();
+        if (value && !value.startsWith("data:")) {
+            return new URL(value, document.baseURI).href;
+        }
+    }
+    return null;
+}
+"""
+
+# collects the URL of every page of a chapter in a single round trip
+EXTRACT_IMGS_JS = f"(imgs) => imgs.map({EXTRACT_IMG_JS})"
 
 
 class SweeperInterface:
@@ -14,11 +95,22 @@ class SweeperInterface:
     """
 
     RETRY = 50
+    # selectors of the collection name, of the chapter links and of the element holding
+    # the pages of a chapter
+    COLLECTION_NAME = None
+    CHAPTER_LINKS = None
+    CHAPTER_CONTAINER = None
 
-    def __init__(self, main_url, dry_run, filters, reverse=False, use_proxies=True):
+    def __init__(self, main_url, dry_run, filters, reverse=False, use_proxies=True, rate_limiter=None,
+                 retry_policy=None, browser_options=None, allowed_hosts=None, browser_pool=None):
         """Initialize the Collector object
         :param main_url: <str> The URL from which to collect chapters and other info
         :param dry_run: <bool> Will only print and not download
+        :param rate_limiter: <RateLimiter> Per host politeness policy shared with the downloader
+        :param retry_policy: <RetryPolicy> Retry policy shared with the downloader
+        :param browser_options: <dict> The "browser" config (pool_size, headless, ...)
+        :param allowed_hosts: <list> Hosts the browser never blocks requests to (scripts a site needs)
+        :param browser_pool: <BrowserPool> Pool leased by the caller, one is started otherwise
         :return: None
         """
         super().__init__()
@@ -31,26 +123,38 @@ class SweeperInterface:
         self.use_proxies = use_proxies
         self.filters = filters
         self.scraper = None
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.start_from = None
+        self.save_chapter = None
+        self.on_clearance = None
+        self.select_chapters = None
+        self.swept_chapters = None
         # playwright
-        self.playwright_context = None
-        self.playwright = None
-        self.browser = None
-        self.page = None
+        self.browser_options = browser_options or {}
+        self.browser_pool = browser_pool
+        # only a pool started by the sweeper is closed by it
+        self.owns_browser_pool = browser_pool is None
+        self.allowed_hosts = allowed_hosts or []
+        # pages that render server side are read over plain HTTP, the browser is the fallback
+        # capturing pages needs the browser to load the chapters
+        self.capture = self.browser_options.get("capture", False)
+        self.http_first = self.browser_options.get("http_first", not self.capture)
+        # chapter name: {page name: bytes} of the pages the browser downloaded while sweeping
+        self.captures = {}
+        self.served = {"http": 0, "browser": 0}
+        self._served_lock = threading.Lock()
 
     def init(self):
-        if self.playwright_context is None:
-            self.playwright_context = sync_playwright()
-            self.playwright_context.start()
-            self.playwright = self.playwright_context._playwright
-            self.browser = self.playwright.webkit.launch(headless=False)
+        if self.browser_pool is None:
+            self.browser_pool = BrowserPool.from_options(self.browser_options)
+            self.owns_browser_pool = True
+        self.browser_pool.start()
 
     def stop(self):
-        if self.playwright_context is not None:
-            self.browser.close()
-            self.playwright.stop()
-        self.playwright_context = None
-        self.playwright = None
-        self.browser = None
+        if self.browser_pool is not None and self.owns_browser_pool:
+            self.browser_pool.close()
+            self.browser_pool = None
 
     def filter_chapters(self):
         print("-" * 75)
@@ -73,6 +177,11 @@ class SweeperInterface:
         for chapter, url in self.chapters.items():
             print("## Chapter:", chapter, " - ", url)
 
+    def throttle(self, url):
+        """Waits until the rate limiter allows a request towards the host of the url"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(url)
+
     def announce_url(self):
         print()
         print("=" * 75)
@@ -80,60 +189,21 @@ class SweeperInterface:
         print("=" * 75)
 
     def get_page(self, url, locator=None):
-        try:
-            if self.browser is None or not self.browser.is_connected():
-                self.browser = self.playwright.webkit.launch(headless=False, chromium_sandbox=True)
-            if self.page is None:
-                self.page = self.browser.new_page()
-            print("- Navigating to URL:", url)
-            stealth_sync(self.page)
-            self.page.goto(url=url, timeout=PAGE_TIMEOUT)
-
-
-            if self.page.url != url:
-                print("- Detected url change!")
-                print("- Waiting for page to load...")
-                self.page.wait_for_load_state(state="load", timeout=PAGE_TIMEOUT)
-                print("- Checking for captcha...")
-                self.page.wait_for_timeout(1500)
-                # captcha = self.page.frame_locator('[title="reCAPTCHA"]').get_by_role(
-                #     "checkbox", name="I'm not a robot"
-                # )
-                # print("- CAPTCHA:", captcha)
-                # if captcha.is_visible(timeout=2000):
-                #     print("- Found captcha thingy. Trying to click...")
-                #     captcha.click(
-                #         button="left",
-                #         delay=750,
-                #         position={"x": 10, "y": 10},
-                #     )
-                #     self.page.wait_for_timeout(1500)
-
-                #     okButton = self.page.locator("#btnSubmit")
-                #     print("- OK BUTTON:", okButton)
-                #     if okButton.is_visible():
-                #         okButton.click(
-                #             button="left",
-                #             delay=750,
-                #             position={"x": 10, "y": 10},
-                #         )
-                #         self.page.wait_for_timeout(1500)
-
-            print("- Waiting for URL...")
-            self.page.wait_for_url(url=url, timeout=PAGE_TIMEOUT)
-            print("- Waiting for page to load...")
-            self.page.wait_for_load_state(state="load", timeout=PAGE_TIMEOUT)
-
-            if locator:
-                self.page.wait_for_selector(locator, timeout=PAGE_TIMEOUT)
-                self.page.locator(locator).focus()
-
-            print("- Page loaded correctly.")
-            return self.page
-        except Exception as e:
-            print("!!! Exception while getting page:", e)
-            self.page = None
-            self.browser.close()
+        """Loads a page in the browser session of the calling pool worker
+        :param url: <str> URL of the page
+        :param locator: <str> Selector to wait for
+        :return: <Page>
+        """
+        return self.browser_pool.current().get_page(
+            url, locator, self.rate_limiter, self.allowed_hosts
+        )
+
+    @property
+    def img_state(self):
+        """Blocked images never become visible, they can only be waited to be in the page"""
+        if self.browser_pool.current().blocks_images:
+            return "attached"
+        return "visible"
 
     def get_name_path(self, dir):
         return os.path.join(dir, self.name)
@@ -141,11 +211,321 @@ class SweeperInterface:
     def get_chapter_imgs(self, chapter_name):
         return self.chapter_imgs[chapter_name]
 
+    def sweep(self, save_chapter=None, on_clearance=None, select_chapters=None, swept_chapters=None):
+        """Collect all chapters and images from chapters
+        :param save_chapter: <callable> save_chapter(name, imgs, captured) called for every swept
+            chapter, captured being the {page name: bytes} the browser downloaded
+        :param on_clearance: <callable> on_clearance(url, cookies, user_agent) called with the
+            cookies of the site every time the browser got through to it
+        :param select_chapters: <callable> select_chapters(url, name, chapters) picking the
+            (chapter name, url) left to do out of the ones found
+        :param swept_chapters: <callable> swept_chapters(name) giving the {chapter name: imgs}
+            swept by an interrupted run, handed to save_chapter without navigating again
+        :return: None
+        """
+        self.save_chapter = save_chapter
+        self.on_clearance = on_clearance
+        self.select_chapters = select_chapters
+        self.swept_chapters = swept_chapters
+        self.announce_url()
+        if self.sweep_collection_http():
+            self.served_by("http", self.main_url)
+        else:
+            self.browser_pool.run(self.sweep_collection_browser)
+            self.served_by("browser", self.main_url)
+        self.sweep_chapters()
+
     def sweep_collection(self):
         raise NotImplemented("You need a concrete instance and not something abstract.")
 
-    def try_sweep_chapter(self, ch_url, ch_name):
-        raise NotImplemented("You need a concrete instance and not something abstract.")
+    def sweep_collection_browser(self):
+        """Sweeps the collection in the browser, keeping the storage state of the site
+        (clearance & consent cookies) for the next runs
+        :return: None
+        """
+        self.sweep_collection()
+        self.browser_pool.current().save_state(self.main_url)
+        self.export_clearance(self.main_url)
+
+    def export_clearance(self, url):
+        """Hands the cookies & user agent of the browser over to on_clearance
+        :param url: <str> URL the browser just got through to
+        :return: None
+        """
+        if self.on_clearance is None:
+            return
+        try:
+            cookies, user_agent = self.browser_pool.current().clearance(url)
+        except Exception as e:
+            print("!!! Exception while exporting browser cookies:", e)
+            return
+        self.on_clearance(url, cookies, user_agent)
+
+    def add_chapters(self, links, page_url):
+        """Registers the chapters found on the collection page
+        :param links: <list> (href, text) of every chapter link
+        :param page_url: <str> URL the collection page was served from
+        :return: None
+        """
+        raise NotImplementedError("You need a concrete instance and not something abstract.")
+
+    def fetch_html(self, url):
+        """Fetches a page with the scraper session, without a browser
+        :param url: <str> URL of the page
+        :return: <tuple> (BeautifulSoup, final URL) or (None, None) if the browser is needed
+        """
+        if not self.http_first or self.scraper is None:
+            return None, None
+        self.throttle(url)
+        try:
+            r = self.scraper.get(url, timeout=HTTP_TIMEOUT)
+        except Exception as e:
+            print("### HTTP fetch failed, using the browser:", e)
+            return None, None
+        if self.rate_limiter is not None:
+            self.rate_limiter.feedback(url, r.status_code, RetryPolicy.retry_after(r))
+        if is_challenge(r):
+            print("### Challenge page, using the browser:", url)
+            return None, None
+        if r.status_code != 200:
+            print(f"### HTTP status {r.status_code}, using the browser:", url)
+            return None, None
+        return BeautifulSoup(r.text, HTML_PARSER), r.url
+
+    def sweep_collection_http(self):
+        """Reads the collection name and chapters from the server side rendered page
+        :return: <bool> False if the browser is needed
+        """
+        soup, page_url = self.fetch_html(self.main_url)
+        if soup is None:
+            return False
+        name = soup.select_one(self.COLLECTION_NAME)
+        links = [(a.get("href"), a.get_text()) for a in soup.select(self.CHAPTER_LINKS)]
+        if name is None or not name.get_text().strip() or not links:
+            print("# Collection not found in the HTML, using the browser...")
+            return False
+        self.name = name.get_text().replace("information", "").strip()
+        print("## Name:", self.name)
+        print("# Finding chapters ...")
+        self.add_chapters(links, page_url)
+        self.filter_chapters()
+        print("=" * 75)
+        return True
+
+    def served_by(self, path, url):
+        with self._served_lock:
+            self.served[path] += 1
+        print(f"### Served by {path}:", url)
+
+    def sweep_chapters(self):
+        """Sweeps the chapters on all the pages of the browser pool at the same time.
+        Chapters are handed to save_chapter as soon as they are swept.
+        :return: None
+        """
+        # visit urls and collect img urls
+        chapters_list = list(self.chapters.items())
+        if self.reverse:
+            print("# Reversing chapters...")
+            chapters_list.reverse()
+        if self.start_from:
+            # counted from 1, the chapter is included
+            print("# Will start from chapter:", self.start_from)
+            chapters_list = chapters_list[self.start_from - 1:]
+        if self.select_chapters is not None:
+            selected = self.select_chapters(self.main_url, self.name, chapters_list)
+            print(f"# {len(chapters_list) - len(selected)} chapters are already archived, skipping them")
+            chapters_list = selected
+        if self.swept_chapters is not None:
+            swept = self.swept_chapters(self.name)
+            resumed = [name for name, _ in chapters_list if name in swept]
+            if resumed:
+                print(f"# {len(resumed)} chapters were swept by the last run, resuming them")
+            for name in resumed:
+                self.chapter_imgs[name] = swept[name]
+                if self.save_chapter:
+                    self.save_chapter(name, swept[name], {})
+            chapters_list = [(name, url) for name, url in chapters_list if name not in swept]
+        print(f"# Sweeping {len(chapters_list)} chapters on {self.browser_pool.size} pages...")
+        # every page sweeps a chapter while another one waits for it: the next chapters are
+        # only handed to the pool once the previous ones are saved, so that a full pipeline
+        # holds the sweep back and captured pages don't pile up
+        max_in_flight = 2 * self.browser_pool.size
+        chapters_left = iter(chapters_list)
+        futures = {}
+        failed = []
+        progress = tqdm(total=len(chapters_list), desc="## Collecting")
+        while True:
+            for name, url in itertools.islice(chapters_left, max_in_flight - len(futures)):
+                futures[self.browser_pool.submit(self.try_sweep_chapter, url, name)] = name
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    swept = future.result()
+                except Exception as e:
+                    # the page was recycled by the pool, the other chapters go on
+                    print(f"!!! Chapter failed: {name} - {e}")
+                    swept = False
+                if not swept:
+                    failed.append(name)
+                elif self.save_chapter:
+                    self.save_chapter(name, self.get_chapter_imgs(name), self.captures.pop(name, {}))
+                progress.update()
+        progress.close()
+        if failed:
+            print(f"# {len(failed)} chapters could not be swept: " + ", ".join(failed))
+
+        # print chapter info
+        print("# Chapters info:")
+        for chapter, imgs in self.chapter_imgs.items():
+            print("## {0}: {1} pages (imgs)".format(chapter, len(imgs)))
+        print("# Served over HTTP: {http} | by the browser: {browser}".format(**self.served))
+        print("=" * 75)
+
+    def try_sweep_chapter(self, url, name):
+        """Sweeps a chapter, retrying as the retry policy says
+        :param url: <str> URL of the chapter
+        :param name: <str> Name of the chapter
+        :return: <bool> True if the chapter was swept
+        """
+        retry = self.retry_policy.start(url)
+        for _ in retry:
+            # pages found by a failed attempt are not to be trusted
+            self.chapter_imgs.pop(name, None)
+            self.captures.pop(name, None)
+            try:
+                self.throttle(url)
+                self.sweep_chapter(url, name)
+                retry.succeeded()
+                return True
+            except Exception as e:
+                helpers.print_error(e)
+                outcome = self.retry_policy.classify_exception(e)
+                if outcome is Outcome.FATAL:
+                    raise
+                # start the next attempt on a fresh page
+                self.browser_pool.current().recycle()
+                if outcome is Outcome.RESET:
+                    print("# Resetting everything and retrying...")
+                    self.clean_scraper()
+                if not retry.failed(outcome):
+                    break
+        print("!!! Giving up on chapter:", name)
+        return False
+
+    def sweep_chapter(self, url, chapter_name):
+        """Finds the pages of a chapter, all at once if possible, one by one otherwise
+        :param url: <str> URL of the chapter
+        :param chapter_name: <str> Name of the chapter
+        :return: None
+        """
+        if self.CHAPTER_CONTAINER is None:
+            raise NotImplementedError("You need a concrete instance and not something abstract.")
+        print("### Switching to chapter:", chapter_name)
+        img_srcs = self.extract_imgs_http(url)
+        served_by_browser = not img_srcs
+        if img_srcs:
+            self.served_by("http", url)
+        else:
+            img_srcs = self.extract_imgs_browser(url)
+            self.served_by("browser", url)
+
+        print("### Determined number of pages: ", len(img_srcs))
+        if not img_srcs:
+            # an empty chapter would be packed as an empty archive, for good
+            raise ConnectionError(f"No pages found on: {url}")
+        self.chapter_imgs[chapter_name] = []
+        for i, img_src in enumerate(img_srcs):
+            img_elem = (str(i + 1) + ".jpg", img_src)
+            print(f"### Page {i+1}:", img_elem)
+            self.chapter_imgs[chapter_name].append(img_elem)
+        if self.capture and served_by_browser:
+            self.captures[chapter_name] = self.capture_imgs(chapter_name)
+
+    def capture_imgs(self, chapter_name):
+        """Keeps the pages of a chapter the browser already downloaded
+        :param chapter_name: <str> Name of the chapter
+        :return: <dict> {page name: bytes} of the whole pages
+        """
+        session = self.browser_pool.current()
+        captured = {}
+        for img_name, img_src in self.chapter_imgs[chapter_name]:
+            data = session.captured_body(img_src)
+            if data and images.is_complete_bytes(data):
+                captured[img_name] = data
+        print(f"### Captured {len(captured)}/{len(self.chapter_imgs[chapter_name])} pages from the browser")
+        return captured
+
+    def extract_imgs_http(self, url):
+        """Reads the URLs of the pages of a chapter from its server side rendered HTML
+        :param url: <str> URL of the chapter
+        :return: <list> URL of every page or None if the browser is needed
+        """
+        soup, page_url = self.fetch_html(url)
+        if soup is None:
+            return None
+        img_srcs = [img_url(img, page_url) for img in soup.select(f"{self.CHAPTER_CONTAINER} img")]
+        if not img_srcs or None in img_srcs:
+            print("### Pages not found in the HTML, using the browser...")
+            return None
+        return img_srcs
+
+    def extract_imgs_browser(self, url):
+        """Loads a chapter in the browser and reads the URLs of its pages
+        :param url: <str> URL of the chapter
+        :return: <list> URL of every page
+        """
+        page = self.get_page(url)
+
+        print("### Waiting for all pages to load...")
+        chapter_container = page.locator(self.CHAPTER_CONTAINER)
+        chapter_container.first.wait_for(timeout=PAGE_TIMEOUT, state="visible")
+
+        img_srcs = self.extract_imgs(page)
+        if not img_srcs or None in img_srcs:
+            print("### Some pages have no URL yet, going through them one by one...")
+            img_srcs = self.extract_imgs_one_by_one(chapter_container)
+        if not img_srcs or None in img_srcs:
+            # an OSError: worth another attempt
+            raise ConnectionError(f"Pages without a URL: {url}")
+        self.export_clearance(url)
+        return img_srcs
+
+    def extract_imgs(self, page):
+        """Reads the URLs of all the pages of a chapter in one go: a single scroll to the bottom
+        starts the lazy loaders, then the URLs are read once the network settles
+        :param page: <Page> Page of the chapter
+        :return: <list> URL of every page, None for pages without one
+        """
+        page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+        try:
+            page.wait_for_load_state(state="networkidle", timeout=NETWORK_IDLE_TIMEOUT)
+        except Exception:
+            # some sites never stop polling, the data-* attributes are usually there already
+            pass
+        return page.eval_on_selector_all(f"{self.CHAPTER_CONTAINER} img", EXTRACT_IMGS_JS)
+
+    def extract_imgs_one_by_one(self, chapter_container):
+        """Slow path: waits for every page and scrolls it into view before reading its URL
+        :param chapter_container: <Locator> Element holding the pages
+        :return: <list> URL of every page, None for pages without one
+        """
+        img_srcs = []
+        host_url = chapter_container.page.url
+        for img in chapter_container.locator("img").all():
+            img.wait_for(timeout=PAGE_TIMEOUT, state=self.img_state)
+            time.sleep(0.1)
+            # scrolling makes the browser load the image from its host, the one of the
+            # previous page: the URL of this one is only there once it is in view
+            self.throttle(host_url)
+            img.scroll_into_view_if_needed()
+            img_src = img.evaluate(EXTRACT_IMG_JS)
+            if img_src:
+                host_url = img_src
+            img_srcs.append(img_src)
+        return img_srcs
 
     def close(self):
         if self.scraper:
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from images import PART_SUFFIX, sniff_format
+
+# format: (Pillow format, file extension)
+FORMATS = {
+    "webp": ("WEBP", ".webp"),
+    "avif": ("AVIF", ".avif"),
+    "jpeg": ("JPEG", ".jpg"),
+}
+
+QUALITY_STEP = 10
+
+
+def transcode_bytes(data, settings):
+    """Re-encodes an image. Runs in the worker processes.
+    :param data: <bytes> The original image
+    :param settings: <dict> Transcoder settings (format, quality, min_quality, max_bytes,
+        max_dimension)
+    :return: <tuple> (bytes, extension) or None if the result is not smaller
+    """
+    # Pillow is only needed when transcoding is enabled
+    from PIL import Image
+
+    pil_format, extension = FORMATS[settings["format"]]
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        max_dimension = settings.get("max_dimension")
+        if max_dimension and max(img.size) > max_dimension:
+            img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if pil_format == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        quality = settings["quality"]
+        while True:
+            out = io.BytesIO()
+            if pil_format == "JPEG":
+                img.save(out, pil_format, quality=quality, optimize=True, progressive=True)
+            elif pil_format == "WEBP":
+                img.save(out, pil_format, quality=quality, method=6)
+            else:
+                img.save(out, pil_format, quality=quality)
+            encoded = out.getvalue()
+            max_bytes = settings.get("max_bytes")
+            if not max_bytes or len(encoded) <= max_bytes:
+                break
+            if quality - QUALITY_STEP < settings["min_quality"]:
+                break
+            quality -= QUALITY_STEP
+    if len(encoded) >= len(data):
+        return None
+    return encoded, extension
+
+
+def transcode_file(path, settings):
+    """Re-encodes an image file, replacing it if the result is smaller. Runs in the worker
+    processes.
+    :param path: <str> Path of the image
+    :param settings: <dict> Transcoder settings
+    :return: <tuple> (final file name, bytes saved)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    result = transcode_bytes(data, settings)
+    if result is None:
+        return os.path.basename(path), 0
+    encoded, extension = result
+    new_path = os.path.splitext(path)[0] + extension
+    tmp_path = new_path + PART_SUFFIX
+    with open(tmp_path, "wb") as f:
+        f.write(encoded)
+    os.replace(tmp_path, new_path)
+    if new_path != path:
+        os.remove(path)
+    return os.path.basename(new_path), len(data) - len(encoded)
+
+
+class Transcoder:
+    """
+    Transcoder shrinks downloaded pages by re-encoding them (WebP, AVIF or optimized JPEG)
+    on a pool of processes. A page keeps its original encoding when the new one is not smaller.
+    Every chapter directory remembers the pages already handled, so they are never re-encoded.
+    """
+
+    DONE_NAME = ".transcoded"
+    DEFAULT_FORMAT = "webp"
+    DEFAULT_QUALITY = 80
+    DEFAULT_MIN_QUALITY = 50
+
+    def __init__(self, image_format=DEFAULT_FORMAT, quality=DEFAULT_QUALITY,
+                 min_quality=DEFAULT_MIN_QUALITY, max_bytes=None, max_dimension=None, workers=None):
+        """Initialize the Transcoder object
+        :param image_format: <str> "webp", "avif" or "jpeg"
+        :param quality: <int> Encoder quality to start with
+        :param min_quality: <int> Lowest quality tried to get a page under max_bytes
+        :param max_bytes: <int> Size target of a page
+        :param max_dimension: <int> Pages are scaled down to fit a square of this size
+        :param workers: <int> Number of processes
+        :return: None
+        """
+        super().__init__()
+        if image_format not in FORMATS:
+            raise ValueError(f"Unsupported transcoding format: {image_format}")
+        self.settings = {
+            "format": image_format,
+            "quality": quality,
+            "min_quality": min(min_quality, quality),
+            "max_bytes": max_bytes,
+            "max_dimension": max_dimension,
+        }
+        self.workers = workers or os.cpu_count()
+        self.executor = None
+        self.saved = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, options):
+        """Creates a Transcoder out of the "transcode" config
+        :param options: <dict> The "transcode" config
+        :return: <Transcoder> or None if transcoding is not configured
+        """
+        if not options or not options.get("enabled", True):
+            return None
+        return cls(
+            image_format=options.get("format", cls.DEFAULT_FORMAT),
+            quality=options.get("quality", cls.DEFAULT_QUALITY),
+            min_quality=options.get("min_quality", cls.DEFAULT_MIN_QUALITY),
+            max_bytes=options.get("max_page_bytes"),
+            max_dimension=options.get("max_dimension"),
+            workers=options.get("workers"),
+        )
+
+    def _get_executor(self):
+        with self._lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def _add_saved(self, saved):
+        with self._lock:
+            self.saved += saved
+
+    def transcode(self, data):
+        """Re-encodes an image in memory
+        :param data: <bytes> The original image
+        :return: <tuple> (bytes, extension); the original bytes and None when not smaller
+        """
+        if sniff_format(data[:16]) is None:
+            return data, None
+        try:
+            result = self._get_executor().submit(transcode_bytes, data, self.settings).result()
+        except Exception as e:
+            print("! Could not transcode page, keeping the original:", e)
+            return data, None
+        if result is None:
+            return data, None
+        self._add_saved(len(data) - len(result[0]))
+        return result
+
+    def transcode_chapter(self, chapter_dir):
+        """Re-encodes the pages of a chapter directory that were not handled yet
+        :param chapter_dir: <str> Directory of the chapter
+        :return: <int> Bytes saved
+        """
+        done_path = os.path.join(chapter_dir, self.DONE_NAME)
+        done = set()
+        if os.path.exists(done_path):
+            with open(done_path) as f:
+                done = set(json.load(f))
+        futures = {}
+        for file_name in sorted(os.listdir(chapter_dir)):
+            path = os.path.join(chapter_dir, file_name)
+            if file_name in done or file_name.startswith(".") or file_name.endswith(PART_SUFFIX):
+                continue
+            futures[file_name] = self._get_executor().submit(transcode_file, path, self.settings)
+        saved = 0
+        for file_name, future in futures.items():
+            try:
+                new_name, page_saved = future.result()
+            except Exception as e:
+                print(f"! Could not transcode {file_name}, keeping the original:", e)
+                new_name, page_saved = file_name, 0
+            done.add(new_name)
+            saved += page_saved
+        if futures:
+            tmp_path = done_path + PART_SUFFIX
+            with open(tmp_path, "w") as f:
+                json.dump(sorted(done), f)
+            os.replace(tmp_path, done_path)
+        self._add_saved(saved)
+        return saved
+
+    def output_exists(self, img_path):
+        """Tells if a page was already replaced by its transcoded version
+        :param img_path: <str> Path of the original page
+        :return: <bool>
+        """
+        extension = FORMATS[self.settings["format"]][1]
+        new_path = os.path.splitext(img_path)[0] + extension
+        return new_path != img_path and os.path.exists(new_path)
+
+    def close(self):
+        with self._lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            self.executor = None
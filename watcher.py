@@ -1,8 +1,204 @@
-import feedparser
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
-NewsFeed = feedparser.parse("https://readcomicsonline.ru/feed")
+import json
+import os
 
-print('Number of RSS posts :', len(NewsFeed.entries))
+from images import PART_SUFFIX
 
-entry = NewsFeed.entries[1]
-print('Post Title :', entry.title)
+# feed entries remembered per feed, to tell the new ones
+MAX_SEEN = 500
+
+
+class Watcher:
+    """
+    Watcher tells which series have new chapters without sweeping them: it polls the "rss"
+    feed of every variant and probes the first chapter link of the series in "watch".
+    Requests are conditional (ETag / Last-Modified), so pages that did not change cost a 304.
+    What it saw is kept on disk, so that a restart does not report everything as new.
+    """
+
+    DEFAULT_STATE_PATH = ".watch-state.json"
+    TIMEOUT = (30, 60)
+
+    def __init__(self, options, variant_keys, state_path=DEFAULT_STATE_PATH):
+        """Initialize the Watcher object
+        :param options: <dict> The whole config
+        :param variant_keys: <dict> Variant: config key of the variants to watch
+        :param state_path: <str> Where the feed & page states are kept
+        :return: None
+        """
+        super().__init__()
+        self.options = options
+        self.variant_keys = variant_keys
+        self.state_path = state_path
+        self.state = self._load()
+        self.scraper = None
+
+    @classmethod
+    def from_options(cls, options, variant_keys):
+        watcher_options = options.get("watcher") or {}
+        return cls(
+            options,
+            variant_keys,
+            state_path=watcher_options.get("state_path", cls.DEFAULT_STATE_PATH),
+        )
+
+    def _load(self):
+        state = {"feeds": {}, "pages": {}}
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    state.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print("! Could not read the watch state, starting over:", e)
+        return state
+
+    def save(self):
+        tmp_path = self.state_path + PART_SUFFIX
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _get(self, url, entry, throttle=None):
+        """Conditional GET: sends the validators of the last response
+        :param url: <str>
+        :param entry: <dict> State of the URL, its validators are updated
+        :param throttle: <callable> Waits for our turn on the host of the URL
+        :return: <Response> or None if the URL did not change
+        :raise ConnectionError: if the URL could not be fetched
+        """
+        if self.scraper is None:
+            import cloudscraper
+
+            self.scraper = cloudscraper.create_scraper()
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("modified"):
+            headers["If-Modified-Since"] = entry["modified"]
+        if throttle is not None:
+            throttle(url)
+        try:
+            r = self.scraper.get(url, headers=headers, timeout=self.TIMEOUT)
+        except Exception as e:
+            raise ConnectionError(f"Could not fetch: {url} - {e}") from e
+        if r.status_code == 304:
+            return None
+        if r.status_code != 200:
+            raise ConnectionError(f"HTTP {r.status_code}: {url}")
+        entry["etag"] = r.headers.get("ETag")
+        entry["modified"] = r.headers.get("Last-Modified")
+        return r
+
+    def poll(self, throttle=None):
+        """Finds the series with new chapters
+        :param throttle: <callable> throttle(variant, url) waiting for our turn on the host
+        :return: <list> (config key, series url) of the series to collect
+        """
+        print("=" * 75)
+        print("# Watching for new chapters...")
+        updated = []
+        for variant, key in self.variant_keys.items():
+            options = self.options.get(key) or {}
+            watched = list(options.get("watch") or [])
+            series = watched + [url for url in options.get("urls") or [] if url not in watched]
+
+            def variant_throttle(url, variant=variant):
+                if throttle is not None:
+                    throttle(variant, url)
+
+            changed = set()
+            probed = watched
+            if options.get("rss"):
+                feed_changed = self._poll_feed(options["rss"], series, variant_throttle)
+                if feed_changed is None:
+                    # the feed can't tell, ask the series pages
+                    probed = series
+                else:
+                    changed |= feed_changed
+            for url in probed:
+                if url not in changed and self._probe(variant, url, variant_throttle):
+                    changed.add(url)
+            for url in series:
+                if url in changed:
+                    print("## New chapters:", url)
+                    updated.append((key, url))
+        print(f"# {len(updated)} series to update")
+        print("=" * 75)
+        return updated
+
+    def _poll_feed(self, feed_url, series, throttle):
+        """Reads the entries of a feed that were not seen yet
+        :param feed_url: <str> URL of the feed
+        :param series: <list> URLs of the series of the variant
+        :param throttle: <callable>
+        :return: <set> URLs of the series that have a new entry, None if the feed failed
+        """
+        entry = self.state["feeds"].setdefault(feed_url, {"seen": []})
+        try:
+            r = self._get(feed_url, entry, throttle)
+        except ConnectionError as e:
+            print("!!! Feed failed, probing its series instead:", e)
+            return None
+        if r is None:
+            print("## Feed unchanged:", feed_url)
+            return set()
+        import feedparser
+
+        feed = feedparser.parse(r.content)
+        seen = set(entry["seen"])
+        changed = set()
+        new = 0
+        for item in feed.entries:
+            item_id = item.get("id") or item.get("link")
+            if not item_id or item_id in seen:
+                continue
+            new += 1
+            entry["seen"].append(item_id)
+            link = item.get("link") or ""
+            for url in series:
+                base = url.rstrip("/")
+                if link == base or link.startswith(base + "/"):
+                    changed.add(url)
+        entry["seen"] = entry["seen"][-MAX_SEEN:]
+        print(f"## Feed: {feed_url} | new entries: {new} | series concerned: {len(changed)}")
+        return changed
+
+    def _probe(self, variant, url, throttle):
+        """Compares the latest chapter link of a series page with the last one seen
+        :param variant: <Variant>
+        :param url: <str> URL of the series
+        :param throttle: <callable>
+        :return: <bool> True if the series has new chapters (or could not be probed)
+        """
+        from bs4 import BeautifulSoup
+
+        from sweepers.factory import SweeperFactory
+        from sweepers.interface import HTML_PARSER
+
+        entry = self.state["pages"].setdefault(url, {})
+        try:
+            r = self._get(url, entry, throttle)
+        except ConnectionError as e:
+            print("## Could not probe, will sweep:", e)
+            return True
+        if r is None:
+            return False
+        links = BeautifulSoup(r.text, HTML_PARSER).select(
+            SweeperFactory.sweeper_class(variant).CHAPTER_LINKS
+        )
+        if not links:
+            # challenge page or changed layout: let the sweeper have a look
+            print("## Could not probe, will sweep:", url)
+            entry["etag"] = entry["modified"] = None
+            return True
+        latest = links[0].get("href")
+        if latest == entry.get("latest"):
+            return False
+        entry["latest"] = latest
+        return True
+
+    def close(self):
+        if self.scraper is not None:
+            self.scraper.close()